@@ -4,18 +4,23 @@ import math
 import sys
 import io
 import json
+import time
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from datetime import datetime
 from typing import Dict, Any, Optional
 from dotenv import load_dotenv
 from langchain.agents import initialize_agent, Tool, AgentType
 from langchain_openai import ChatOpenAI
-from langchain_community.tools import DuckDuckGoSearchRun, WikipediaQueryRun
-from langchain_community.utilities import WikipediaAPIWrapper
+from langchain_community.tools import DuckDuckGoSearchRun
+import requests
 # 添加新的搜索包，因为langchain的DuckDuckGo集成已废弃
 from ddgs import DDGS  # 不是 from duckduckgo_search import DDGS
 from langchain.prompts import PromptTemplate
 from langchain_core.callbacks import BaseCallbackHandler
 import tiktoken
+from search_cache import SearchCache
 
 # 加载环境变量
 env_path = os.path.join(os.path.dirname(__file__), ".env")
@@ -35,51 +40,137 @@ DEEPSEEK_PRICING = {
 }
 
 class CostTracker(BaseCallbackHandler):
-    """追踪API调用成本"""
-    def __init__(self):
+    """追踪API调用成本
+
+    按接口返回的 usage 记账（DeepSeek 会返回缓存命中的 token 数，命中部分按缓存价计），
+    和账单口径一致；只有接口没返回 usage 时才用 tiktoken 本地估算。
+    每次调用只记一条很小的记录，开着也几乎没有开销。
+    每个请求用自己的 CostTracker（见 new_request_callbacks），parent 指向全局的 cost_tracker，
+    记账时同时累加到 parent，并发请求之间互不干扰，全局总数也不会漏。
+    """
+    MAX_CALL_RECORDS = 1000   # 最近多少次调用的明细
+    PREFIX_CACHE_SIZE = 32    # 本地估算时缓存多少个 prompt 的 token 数
+
+    def __init__(self, parent: Optional["CostTracker"] = None):
+        self.parent = parent
         self.total_tokens = 0
         self.total_input_tokens = 0
         self.total_output_tokens = 0
+        self.total_cache_hit_tokens = 0
         self.total_cost = 0.0
-        self.encoding = tiktoken.encoding_for_model("gpt-4")  # DeepSeek兼容
-        
+        self.estimated_calls = 0   # 没有 usage、靠本地估算的调用次数
+        self.calls = deque(maxlen=self.MAX_CALL_RECORDS)
+        self._prompts = {}         # run_id -> prompts，只在接口没返回 usage 时才用来估算
+        self._prefix_counts = OrderedDict()   # prompt -> token 数
+        self._encoding = None
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        if self._encoding is None:
+            self._encoding = tiktoken.encoding_for_model("gpt-4")  # DeepSeek兼容（近似）
+        return self._encoding
+
     def on_llm_start(self, serialized: Dict[str, Any], prompts: list[str], **kwargs) -> None:
-        """LLM调用开始时估算输入tokens"""
-        for prompt in prompts:
-            self.total_input_tokens += len(self.encoding.encode(prompt))
-    
+        """LLM调用开始时只记下 prompt，不做分词（usage 里有准确的输入 token 数）"""
+        self._prompts[kwargs.get("run_id")] = prompts
+
+    def on_llm_error(self, error, **kwargs) -> None:
+        self._prompts.pop(kwargs.get("run_id"), None)
+
     def on_llm_end(self, response, **kwargs) -> None:
-        """LLM调用结束时计算输出tokens和成本"""
-        if hasattr(response, 'generations'):
-            for generation in response.generations:
-                for gen in generation:
-                    if hasattr(gen, 'text'):
-                        self.total_output_tokens += len(self.encoding.encode(gen.text))
-        
-        # 计算本次调用成本（假设都是未缓存）
-        input_cost = self.total_input_tokens * DEEPSEEK_PRICING["input_uncached"]
-        output_cost = self.total_output_tokens * DEEPSEEK_PRICING["output"]
-        self.total_cost = input_cost + output_cost
-        self.total_tokens = self.total_input_tokens + self.total_output_tokens
-    
+        """LLM调用结束时按 usage 计算本次的 token 和成本，累加到总数"""
+        prompts = self._prompts.pop(kwargs.get("run_id"), None) or []
+        usage = self._extract_usage(response)
+        if usage is None:
+            usage = self._estimate_usage(prompts, response)
+        hit = usage["cache_hit_tokens"]
+        cost = (hit * DEEPSEEK_PRICING["input_cached"]
+                + (usage["input_tokens"] - hit) * DEEPSEEK_PRICING["input_uncached"]
+                + usage["output_tokens"] * DEEPSEEK_PRICING["output"])
+        self.add_record(dict(usage, cost=cost, time=time.time()))
+
+    def add_record(self, record: dict) -> None:
+        """累加一次调用的 token 和成本（加锁，多个线程可以同时调用），再转给 parent"""
+        with self._lock:
+            self.calls.append(record)
+            self.total_input_tokens += record["input_tokens"]
+            self.total_output_tokens += record["output_tokens"]
+            self.total_cache_hit_tokens += record["cache_hit_tokens"]
+            self.total_tokens = self.total_input_tokens + self.total_output_tokens
+            self.total_cost += record["cost"]
+            self.estimated_calls += record["estimated"]
+        if self.parent is not None:
+            self.parent.add_record(record)
+
+    @staticmethod
+    def _extract_usage(response) -> Optional[dict]:
+        """从 llm_output["token_usage"] 或消息的 usage_metadata 里取 token 数，都没有返回 None"""
+        token_usage = (getattr(response, "llm_output", None) or {}).get("token_usage")
+        if token_usage and token_usage.get("prompt_tokens") is not None:
+            hit = token_usage.get("prompt_cache_hit_tokens")   # DeepSeek 的字段
+            if hit is None:
+                hit = (token_usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+            return {"input_tokens": token_usage["prompt_tokens"], "output_tokens": token_usage.get("completion_tokens", 0),
+                    "cache_hit_tokens": hit, "estimated": False}
+        # 流式调用时 llm_output 里没有 usage，在消息的 usage_metadata 里
+        usage = None
+        for generation in getattr(response, "generations", []):
+            for gen in generation:
+                metadata = getattr(getattr(gen, "message", None), "usage_metadata", None)
+                if metadata:
+                    usage = usage or {"input_tokens": 0, "output_tokens": 0, "cache_hit_tokens": 0, "estimated": False}
+                    usage["input_tokens"] += metadata.get("input_tokens", 0)
+                    usage["output_tokens"] += metadata.get("output_tokens", 0)
+                    usage["cache_hit_tokens"] += (metadata.get("input_token_details") or {}).get("cache_read", 0) or 0
+        return usage
+
+    def _estimate_usage(self, prompts, response) -> dict:
+        """本地估算（全部按未命中缓存计）"""
+        output_tokens = 0
+        for generation in getattr(response, "generations", []):
+            for gen in generation:
+                if getattr(gen, "text", None):
+                    output_tokens += len(self.encoding.encode(gen.text))
+        return {"input_tokens": sum(self._count_prompt(p) for p in prompts), "output_tokens": output_tokens,
+                "cache_hit_tokens": 0, "estimated": True}
+
+    def _count_prompt(self, prompt: str) -> int:
+        """ReAct 每一轮的 prompt 都是上一轮加上新的 scratchpad，只对新增的部分分词"""
+        with self._lock:
+            base, base_count = "", 0
+            for cached, count in reversed(self._prefix_counts.items()):
+                if len(cached) > len(base) and prompt.startswith(cached):
+                    base, base_count = cached, count
+        count = base_count + len(self.encoding.encode(prompt[len(base):]))   # 接缝处可能差一两个 token
+        with self._lock:
+            self._prefix_counts[prompt] = count
+            self._prefix_counts.move_to_end(prompt)
+            while len(self._prefix_counts) > self.PREFIX_CACHE_SIZE:
+                self._prefix_counts.popitem(last=False)
+        return count
+
     def get_summary(self) -> str:
         """获取成本摘要"""
+        estimated = f"\n- 其中 {self.estimated_calls} 次调用没有返回 usage，按本地分词估算" if self.estimated_calls else ""
         return f"""
 成本统计（DeepSeek 2025年10月定价）:
-- 输入 tokens: {self.total_input_tokens:,}
+- 输入 tokens: {self.total_input_tokens:,}（缓存命中 {self.total_cache_hit_tokens:,}）
 - 输出 tokens: {self.total_output_tokens:,}
 - 总 tokens: {self.total_tokens:,}
-- 预估成本: ¥{self.total_cost:.4f}
+- 成本: ¥{self.total_cost:.4f}{estimated}
 """
 
-cost_tracker = CostTracker() if TRACK_COSTS else None
+cost_tracker = CostTracker() if TRACK_COSTS else None  # 全局总数，只汇总各请求的记录，不直接挂到 LLM 上
 class LoggingCallbackHandler(BaseCallbackHandler):
-    """记录Agent思考过程"""
+    """记录Agent思考过程（每个请求一个实例）"""
     def __init__(self):
         self.logs = []
     
     def on_chain_start(self, serialized, inputs, **kwargs):
-        self.logs.append(f"Question: {inputs.get('input', '')}")
+        # 回调通过 config 传入后，内层的 LLMChain 也会触发，只记最外层的问题
+        if kwargs.get("parent_run_id") is None and isinstance(inputs, dict):
+            self.logs.append(f"Question: {inputs.get('input', '')}")
     
     def on_llm_start(self, serialized, prompts, **kwargs):
         if prompts and "Thought:" in prompts[0]:
@@ -97,7 +188,15 @@ class LoggingCallbackHandler(BaseCallbackHandler):
     def reset(self):
         self.logs = []
 
-log_handler = LoggingCallbackHandler()
+def new_request_callbacks():
+    """每次调用 Agent 新建一组回调，返回 (成本追踪, 思考过程日志, 回调列表)
+
+    通过 agent.invoke(..., config={"callbacks": 回调列表}) 传入，只对这一次调用生效，
+    同时处理多个请求时各自的成本和思考过程不会混在一起。
+    """
+    tracker = CostTracker(parent=cost_tracker) if TRACK_COSTS else None
+    logger = LoggingCallbackHandler()
+    return tracker, logger, [h for h in (tracker, logger) if h is not None]
 
 def get_api_config():
     """运行时获取API配置"""
@@ -117,52 +216,105 @@ def fake_calculator(expression: str) -> str:
     return f"[模拟计算] {expression} = 42"
 
 # ========== 真实工具 ==========
-# 删除原来的 safe_search 修正一下 因为原来的单源搜索太容易出现搜索不到结果等问题了
-def safe_search(query: str) -> str:
-    """多源搜索，带缓存和降级"""
-    if not hasattr(safe_search, 'cache'):
-        safe_search.cache = {}
-    
-    if query in safe_search.cache:
-        return f"[缓存] {safe_search.cache[query]}"
-    
-    # 使用新的ddgs包替代废弃的DuckDuckGoSearchRun
+# 搜索缓存：内存 LRU + SQLite（search_cache.sqlite3），重启不丢，命令行和 API 服务共用，一天后过期
+search_cache = SearchCache()
+
+# 搜索和 Wikipedia 合成一个工具：两边并发查询，各有各的时限，到点没回来的就不等了
+# 原来分成 Search / Wiki 两个工具时，Agent 经常要多走一轮 ReAct（多一次 LLM 调用）才查第二个来源
+DDG_TIMEOUT = 4.0    # DuckDuckGo 最多等几秒
+WIKI_TIMEOUT = 5.0   # Wikipedia 最多等几秒
+WIKI_API = "https://en.wikipedia.org/w/api.php"   # 和原来的 WikipediaAPIWrapper 一样查英文维基
+WIKI_MAX_CHARS = 4000                             # 返回给 Agent 的 Wikipedia 内容上限（同 WikipediaAPIWrapper）
+search_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="search")   # 常驻线程池，不用每次新建线程
+_ddgs_local = threading.local()
+_wiki_local = threading.local()
+
+def get_ddgs() -> DDGS:
+    """每个线程复用一个 DDGS 会话（连接池），不再每次搜索都新建"""
+    if getattr(_ddgs_local, "client", None) is None:
+        _ddgs_local.client = DDGS(timeout=int(DDG_TIMEOUT) + 1)
+    return _ddgs_local.client
+
+def ddg_search(query: str) -> Optional[str]:
+    """DuckDuckGo 搜索，返回前2个结果的摘要；没有相关结果返回 None"""
     try:
-        with DDGS() as ddgs:
-            results = list(ddgs.text(query.strip(), max_results=3))
-            if results:
-                # 检查结果相关性
-                relevant = any(word in str(results).lower() 
-                             for word in query.lower().split() 
-                             if len(word) > 2)
-                
-                if relevant:
-                    # 组合前2个结果
-                    result = "\n".join([r['body'] for r in results[:2]])
-                    safe_search.cache[query] = result
-                    return result
-                else:
-                    # 结果不相关，提示AI可以换个方式
-                    return f"搜索'{query}'返回了不相关结果。建议：1)尝试英文（若英文不行则其他语言也可以尝试 按照语言使用率从高到低顺序尝试）关键词 2)使用更具体的搜索词 3)换个表述方式"
-    except Exception as e:
-        pass
-    
-    return f"搜索暂时失败。建议：1)用英文（若英文不行则其他语言也可以尝试 按照语言使用率从高到低顺序尝试）重试 2)简化搜索词 3)访问: https://www.google.com/search?q={query.replace(' ', '+')}"
-
-
-
-def safe_wikipedia(query: str) -> str:
-    """包装Wikipedia工具，确保返回有效结果"""
+        results = list(get_ddgs().text(query.strip(), max_results=3))
+    except Exception:
+        _ddgs_local.client = None   # 会话可能已经坏了，下次重建
+        raise
+    # 检查结果相关性
+    relevant = any(word in str(results).lower() for word in query.lower().split() if len(word) > 2)
+    if results and relevant:
+        # 组合前2个结果
+        return "\n".join([r['body'] for r in results[:2]])
+    return None
+
+def get_wiki_session() -> requests.Session:
+    """每个线程复用一个 HTTP 会话（keep-alive），和 DDGS 一样不再每次搜索都新建连接"""
+    if getattr(_wiki_local, "session", None) is None:
+        session = requests.Session()
+        session.headers["User-Agent"] = "jiuye-agent-demo/1.0"
+        _wiki_local.session = session
+    return _wiki_local.session
+
+def _wiki_get(params: dict) -> dict:
+    # 每个请求都带超时：wikipedia 包里的 requests.get 没有超时，服务器不回就一直占着线程池的线程
+    response = get_wiki_session().get(WIKI_API, params=dict(params, action="query", format="json"),
+                                      timeout=WIKI_TIMEOUT)
+    response.raise_for_status()
+    return response.json()["query"]
+
+def wiki_search(query: str) -> Optional[str]:
+    """直接调 MediaWiki API：一次请求搜前3个词条，一次请求取它们的摘要；没有结果返回 None"""
     try:
-        result = wikipedia.run(query)
-        if not result or result == "No good Wikipedia Search Result was found":
-            return f"Wikipedia未找到关于 '{query}' 的页面。请尝试英文（若英文不行则其他语言也可以尝试 按照语言使用率从高到低顺序尝试）搜索或更通用的关键词。"
-        return result
-    except Exception as e:
-        return f"Wikipedia查询出错: {type(e).__name__}: {e}"
+        titles = [hit["title"] for hit in _wiki_get({"list": "search", "srsearch": query.strip(), "srlimit": 3})["search"]]
+        if not titles:
+            return None
+        pages = _wiki_get({"prop": "extracts", "exintro": 1, "explaintext": 1, "exlimit": len(titles),
+                           "redirects": 1, "titles": "|".join(titles)})["pages"]
+    except Exception:
+        _wiki_local.session = None   # 会话可能已经坏了，下次重建
+        raise
+    extracts = {page["title"]: page.get("extract", "") for page in pages.values()}
+    order = [t for t in titles if t in extracts] + [t for t in extracts if t not in titles]   # 按搜索排名
+    summaries = [f"Page: {title}\nSummary: {extracts[title]}" for title in order if extracts[title]]
+    return "\n\n".join(summaries)[:WIKI_MAX_CHARS] or None
+
+# 删除原来的 safe_search 修正一下 因为原来的单源搜索太容易出现搜索不到结果等问题了
+def safe_search(query: str) -> str:
+    """多源搜索（DuckDuckGo + Wikipedia 并发），带缓存、超时和降级"""
+    cached = search_cache.get(query)
+    if cached is not None:
+        return f"[缓存] {cached}"
+
+    start = time.monotonic()
+    sources = [("网络搜索", search_pool.submit(ddg_search, query), DDG_TIMEOUT),
+               ("Wikipedia", search_pool.submit(wiki_search, query), WIKI_TIMEOUT)]
+    sections, notes = [], []
+    for name, future, deadline in sources:
+        try:
+            result = future.result(timeout=max(0.0, deadline - (time.monotonic() - start)))
+        except FutureTimeoutError:
+            future.cancel()   # 还在排队没开始的就不跑了，别占着线程池拖慢后面的请求
+            notes.append(f"{name}超过{deadline:g}秒未返回，已跳过")
+            continue
+        except Exception as e:
+            notes.append(f"{name}出错: {type(e).__name__}")
+            continue
+        if result:
+            sections.append(f"[{name}]\n{result}")
+
+    if sections:
+        result = "\n\n".join(sections)
+        if not notes:
+            search_cache.put(query, result)   # 有来源超时或出错时不缓存，免得一天内都拿到不完整的结果
+        return result + (f"\n（{'；'.join(notes)}）" if notes else "")
+    if not notes:
+        # 两边都正常返回但都没有相关内容，提示AI可以换个方式
+        return f"搜索'{query}'没有找到相关结果（网络和Wikipedia都查过了）。建议：1)尝试英文（若英文不行则其他语言也可以尝试 按照语言使用率从高到低顺序尝试）关键词 2)使用更具体的搜索词 3)换个表述方式"
+    return f"搜索暂时失败（{'；'.join(notes)}）。建议：1)用英文（若英文不行则其他语言也可以尝试 按照语言使用率从高到低顺序尝试）重试 2)简化搜索词 3)访问: https://www.google.com/search?q={query.replace(' ', '+')}"
 
 # search_tool = DuckDuckGoSearchRun() if USE_REAL_TOOLS else None  # 废弃，不再使用
-wikipedia = WikipediaQueryRun(api_wrapper=WikipediaAPIWrapper()) if USE_REAL_TOOLS else None
 
 # 自定义 Python REPL 实现
 class SafePythonREPL:
@@ -179,13 +331,16 @@ class SafePythonREPL:
                 code = code[:-3]
             code = code.strip()
             
-            old_stdout = sys.stdout
-            sys.stdout = io.StringIO()
+            # print 写到这次执行自己的缓冲区，不替换全局的 sys.stdout（并发请求同时执行代码时不会串输出）
+            buffer = io.StringIO()
+            def local_print(*args, **kwargs):
+                kwargs["file"] = buffer
+                print(*args, **kwargs)
             
             # 创建受限但功能丰富的执行环境
             exec_globals = {
                 '__builtins__': {
-                    'print': print, 'range': range, 'len': len, 'sum': sum,
+                    'print': local_print, 'range': range, 'len': len, 'sum': sum,
                     'min': min, 'max': max, 'abs': abs, 'round': round,
                     'sorted': sorted, 'list': list, 'dict': dict, 'set': set,
                     'tuple': tuple, 'str': str, 'int': int, 'float': float,
@@ -197,7 +352,7 @@ class SafePythonREPL:
             
             # 支持变量赋值和多行代码
             exec(code, exec_globals)
-            output = sys.stdout.getvalue()
+            output = buffer.getvalue()
             
             # 如果没有print输出，尝试eval最后一行
             if not output:
@@ -214,8 +369,6 @@ class SafePythonREPL:
             
         except Exception as e:
             return f"执行错误: {type(e).__name__}: {e}"
-        finally:
-            sys.stdout = old_stdout
 
 python_repl = SafePythonREPL() if USE_REAL_TOOLS else None
 
@@ -242,8 +395,7 @@ def get_current_time(format: str = "") -> str:
 # ========== 构建工具列表 ==========
 if USE_REAL_TOOLS:
     tools = [
-    Tool(name="Search", func=safe_search, description="搜索网络"),
-    Tool(name="Wiki", func=safe_wikipedia, description="查Wikipedia"),
+    Tool(name="Search", func=safe_search, description="搜索网络，同时查Wikipedia，一次返回两边的结果"),
     Tool(name="Calc", func=real_calculator, description="数学计算"),
     Tool(name="Time", func=get_current_time, description="Get current time. Leave empty for default format"),
     Tool(name="Python", func=python_repl.run, description="执行Python")
@@ -257,13 +409,12 @@ else:
 # ========== 初始化 LLM ==========
 try:
     config = get_api_config()
-    callbacks = [cost_tracker, log_handler] if TRACK_COSTS else [log_handler]
+    # 回调不挂在 LLM 上（那样所有请求共用一份），每次 invoke 时再传，见 new_request_callbacks
     llm = ChatOpenAI(
         api_key=config["api_key"],
         base_url=config["base_url"],
         model="deepseek-chat",
         temperature=0,
-        callbacks=callbacks
     )
 except ValueError as e:
     print(f"配置错误: {e}")
@@ -341,7 +492,8 @@ def run_tests():
     for query in test_queries:
         print(f"\n{'='*50}\n问题: {query}\n{'-'*50}")
         try:
-            result = agent.invoke({"input": query})["output"]  # 不是 agent.run(query)
+            _, log_handler, callbacks = new_request_callbacks()
+            result = agent.invoke({"input": query}, config={"callbacks": callbacks})["output"]  # 不是 agent.run(query)
             print(f"\n最终答案: {result}")
             # 日志记录
             with open("agent_logs.txt", "a", encoding="utf-8") as f:
@@ -349,7 +501,6 @@ def run_tests():
                 f.write(f"问题: {query}\n")
                 f.write(f"回答: {result}\n")
                 f.write(f"完整过程:\n{log_handler.get_full_log()}\n")
-                log_handler.reset()
                 if TRACK_COSTS:
                     f.write(cost_tracker.get_summary())
                 f.write("\n" + "="*50 + "\n")
@@ -391,7 +542,8 @@ def interactive_mode():
                 continue
                 
             print(f"\n{'-'*50}")
-            result = agent.invoke({"input": user_input})["output"]  # 注意是user_input不是query,run方法已经不能用了 改为invoke。
+            _, log_handler, callbacks = new_request_callbacks()
+            result = agent.invoke({"input": user_input}, config={"callbacks": callbacks})["output"]  # 注意是user_input不是query,run方法已经不能用了 改为invoke。
             print(f"\n最终答案: {result}")
             # 日志记录
             with open("agent_logs.txt", "a", encoding="utf-8") as f:
@@ -399,7 +551,6 @@ def interactive_mode():
                 f.write(f"问题: {user_input}\n")
                 f.write(f"回答: {result}\n")
                 f.write(f"完整过程:\n{log_handler.get_full_log()}\n")
-                log_handler.reset()
                 if TRACK_COSTS:
                     f.write(cost_tracker.get_summary())
                 f.write("\n" + "="*50 + "\n")
@@ -1,37 +1,95 @@
-#尝试于agent里面加入RAG 为保持环境独立性，RAG查询和Agent分析采用分离架构 故废止
+#尝试于agent里面加入RAG 为保持环境独立性，RAG查询和Agent分析采用分离架构
+#RAG 服务（RAG_demo/rag_server.py）在 rag_env 里常驻，这里只是一个轻量客户端：
+#连本地端口发一行 JSON、收一行 JSON，不需要 rag_env 的任何依赖，也不再每次查询都重新加载索引
 
 import subprocess
+import socket
+import json
+import time
 import sys
 import os
 
-if __name__ == "__main__":
-    query = sys.argv[1]
-    
+HOST = "127.0.0.1"
+PORT = int(os.getenv("RAG_SERVER_PORT", "8765"))
+RAG_PYTHON = r"D:\jiuye\environments\rag_env\python.exe"
+RAG_DIR = r"D:\jiuye\RAG_demo"
+START_TIMEOUT = 600   # 首次启动可能要解析PDF、建索引，等久一点
+SERVER_LOG = os.path.join(RAG_DIR, "rag_server.log")   # 自动启动的服务的输出写到这里，启动失败时看这个文件
+
+
+def request(payload: dict, timeout: float = 300) -> dict:
+    """发送一个请求并等待对应的响应"""
+    payload.setdefault("id", f"{os.getpid()}-{time.time_ns()}")
+    with socket.create_connection((HOST, PORT), timeout=timeout) as sock:
+        sock.sendall((json.dumps(payload, ensure_ascii=False) + "\n").encode("utf-8"))
+        with sock.makefile("r", encoding="utf-8") as f:
+            for line in f:
+                response = json.loads(line)
+                if response.get("id") == payload["id"]:
+                    return response
+    raise ConnectionError("RAG 服务断开了连接")
+
+
+def _log_tail(path: str, lines: int = 20) -> str:
+    try:
+        with open(path, "r", encoding="utf-8", errors="replace") as f:
+            return "".join(f.readlines()[-lines:]).strip()
+    except OSError:
+        return ""
+
+
+def start_server():
+    """后台启动 rag_server.py，等它能响应 ping 为止；服务进程提前退出时立即报错，不等到超时"""
     # 创建干净的环境变量，移除所有Python相关路径
-    env = {k: v for k, v in os.environ.items() 
+    env = {k: v for k, v in os.environ.items()
            if not k.startswith(('PYTHON', 'CONDA', 'VIRTUAL'))}
     env['PATH'] = os.environ['PATH']  # 保留系统PATH
-    
-    # 直接调用rag_env的python
-    proc = subprocess.Popen(
-        [r"D:\jiuye\environments\rag_env\python.exe", r"D:\jiuye\RAG_demo\rag_multi.py"],
-        stdin=subprocess.PIPE,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE,
-        text=True,
-        encoding='gbk',
-        cwd=r"D:\jiuye\RAG_demo",  # 确保在正确目录
-        env=env
-    )
-    
-    # 发送查询并退出
-    stdout, stderr = proc.communicate(input=f"{query}\nexit\n")
-    
-    # 提取回答
-    if "回答:" in stdout:
-        answer = stdout.split("回答:")[-1].split("可输入")[0].strip()
-        print(answer)
-    elif stderr:
-        print(f"错误: {stderr.strip()}")
-    else:
-        print("无输出")
+    flags = getattr(subprocess, "DETACHED_PROCESS", 0) | getattr(subprocess, "CREATE_NEW_PROCESS_GROUP", 0)
+    with open(SERVER_LOG, "ab") as log:   # 子进程继承了句柄，这边关掉不影响它继续写
+        proc = subprocess.Popen(
+            [RAG_PYTHON, os.path.join(RAG_DIR, "rag_server.py")],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            cwd=RAG_DIR,  # 确保在正确目录
+            env=env,
+            creationflags=flags,
+            start_new_session=(os.name != "nt"),
+        )
+    deadline = time.time() + START_TIMEOUT
+    while time.time() < deadline:
+        try:
+            return request({"op": "ping"}, timeout=5)
+        except OSError:
+            pass
+        code = proc.poll()
+        if code is not None:
+            try:   # 可能是别的客户端同时拉起了服务，这个进程因为端口被占用退出
+                return request({"op": "ping"}, timeout=5)
+            except OSError:
+                pass
+            tail = _log_tail(SERVER_LOG)
+            raise RuntimeError(f"RAG 服务启动失败（退出码 {code}），日志见 {SERVER_LOG}" + (f"\n{tail}" if tail else ""))
+        time.sleep(1)
+    raise TimeoutError(f"RAG 服务启动超时，日志见 {SERVER_LOG}")
+
+
+def ask(query: str, auto_start: bool = True) -> str:
+    try:
+        response = request({"op": "ask", "query": query})
+    except ConnectionRefusedError:
+        if not auto_start:
+            raise
+        start_server()
+        response = request({"op": "ask", "query": query})
+    if not response.get("ok"):
+        return f"错误: {response.get('error')}"
+    return response["answer"]
+
+
+if __name__ == "__main__":
+    query = sys.argv[1]
+    try:
+        print(ask(query))
+    except (OSError, TimeoutError, RuntimeError) as e:
+        print(f"错误: {e}")
@@ -0,0 +1,119 @@
+# Agent_demo/search_cache.py
+# 搜索结果缓存：内存 LRU + SQLite 落盘，带过期时间和容量上限
+# SQLite 用 WAL 模式，命令行版和 FastAPI 服务可以同时读写同一个缓存文件
+import os
+import re
+import time
+import sqlite3
+import threading
+import unicodedata
+from collections import OrderedDict
+
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH",
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), "search_cache.sqlite3"))
+SEARCH_CACHE_TTL = 24 * 3600      # 搜索结果一天后过期（新闻、价格之类的信息会变）
+MEMORY_ENTRIES = 256              # 内存里最多缓存多少条
+DISK_ENTRIES = 10000              # 磁盘上最多缓存多少条，超出后删最久没用过的
+
+
+def normalize_query(query: str) -> str:
+    """全角半角、大小写、多余空白、首尾标点不同的查询算同一个"""
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = re.sub(r"\s+", " ", query)
+    return query.strip(" \t\"'`?？!！。.,，、;；:：")
+
+
+class SearchCache:
+    """两级缓存：先查内存 LRU，没有再查 SQLite，命中后放回内存
+
+    线程安全：内存部分用锁保护，SQLite 每个线程一个连接。hits / misses 计数可以通过 stats() 查看。
+    """
+    def __init__(self, path: str = SEARCH_CACHE_PATH, ttl: float = SEARCH_CACHE_TTL,
+                 memory_entries: int = MEMORY_ENTRIES, disk_entries: int = DISK_ENTRIES):
+        self.path = path
+        self.ttl = ttl
+        self.memory_entries = memory_entries
+        self.disk_entries = disk_entries
+        self._memory = OrderedDict()   # 键 -> (写入时间, 结果)，越靠后越是最近用过的
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        with self._connect() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS search_cache ("
+                         "key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL, last_used REAL NOT NULL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_search_cache_last_used ON search_cache(last_used)")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5.0)   # 别的进程在写时最多等5秒
+            conn.execute("PRAGMA journal_mode=WAL")           # 读写互不阻塞
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _remember(self, key: str, created: float, value: str):
+        with self._lock:
+            self._memory[key] = (created, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, query: str):
+        """返回缓存的结果，没有或已过期返回 None"""
+        key = normalize_query(query)
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None and now - item[0] <= self.ttl:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return item[1]
+            if item is not None:
+                del self._memory[key]
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT value, created FROM search_cache WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[1] <= self.ttl:
+                    conn.execute("UPDATE search_cache SET last_used = ? WHERE key = ?", (now, key))
+                else:
+                    row = None
+        except sqlite3.Error as e:   # 缓存出问题不能影响搜索本身
+            print(f"[搜索缓存] 读取失败: {type(e).__name__}: {e}")
+            row = None
+        if row is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        self._remember(key, row[1], row[0])
+        with self._lock:
+            self.disk_hits += 1
+        return row[0]
+
+    def put(self, query: str, value: str):
+        key = normalize_query(query)
+        now = time.time()
+        self._remember(key, now, value)
+        try:
+            with self._connect() as conn:
+                conn.execute("INSERT OR REPLACE INTO search_cache (key, value, created, last_used) VALUES (?, ?, ?, ?)",
+                             (key, value, now, now))
+                conn.execute("DELETE FROM search_cache WHERE created < ?", (now - self.ttl,))
+                conn.execute("DELETE FROM search_cache WHERE key IN (SELECT key FROM search_cache "
+                             "ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.disk_entries,))
+        except sqlite3.Error as e:
+            print(f"[搜索缓存] 写入失败: {type(e).__name__}: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            total = hits + self.misses
+            stats = {"memory_hits": self.memory_hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                     "hit_rate": round(hits / total, 4) if total else 0.0, "memory_entries": len(self._memory)}
+        try:
+            stats["disk_entries"] = self._connect().execute("SELECT COUNT(*) FROM search_cache").fetchone()[0]
+        except sqlite3.Error:
+            stats["disk_entries"] = None
+        return stats
@@ -0,0 +1,177 @@
+# RAG_demo/answer_cache.py
+# 语义答案缓存：问题向量和以前问过的问题足够接近时，直接返回上次的回答，不再检索、不再调用 LLM
+# 回答依据的片段所在文件变了（片段ID里带文件内容哈希）、切分参数变了，缓存自动作废
+import os
+import json
+import time
+import pickle
+import atexit
+import threading
+from collections import OrderedDict
+import numpy as np
+
+ANSWER_CACHE_PATH = "answer_cache.pkl"
+SIMILARITY_THRESHOLD = 0.92          # 余弦相似度达到这个值才算同一个问题（换个说法、多个标点一般在 0.95 以上）
+MAX_ENTRIES = 2000                   # 超出后淘汰最久没用过的
+TTL_SECONDS = 7 * 24 * 3600          # 超过这么久的回答不再使用
+SAVE_INTERVAL = 5.0                  # 后台线程每隔这么久把有改动的缓存写盘一次
+
+
+def chunks_are_current(manifest: dict, chunk_ids) -> bool:
+    """片段ID = 路径#内容哈希前12位#序号（见 retriever.chunk_id），文件还在且内容没变，片段就没变"""
+    files = manifest.get("files", {})
+    for cid in chunk_ids:
+        path, sha, _ = cid.rsplit("#", 2)
+        info = files.get(path)
+        if info is None or info["sha256"][:12] != sha:
+            return False
+    return True
+
+
+def _settings_key(manifest: dict) -> str:
+    # 切分参数、Embedding 模型变了，同一个片段ID对应的内容也会变
+    return json.dumps(manifest.get("settings"), sort_keys=True)
+
+
+class AnswerCache:
+    """按问题向量查找的答案缓存，LRU + TTL 淘汰
+
+    检索范围（@文件名:页码）不同的问题不共用缓存。线程安全，rag_server 的多个连接可以共用一个实例。
+    落盘和 JsonlLogger 一样放在后台线程里：get/put 只改内存并标记有改动，后台线程每 save_interval 秒
+    写一次（先写临时文件再替换），程序退出时再写一次，查询不会因为写盘卡住。
+    """
+    def __init__(self, path: str = ANSWER_CACHE_PATH, threshold: float = SIMILARITY_THRESHOLD,
+                 max_entries: int = MAX_ENTRIES, ttl: float = TTL_SECONDS, save_interval: float = SAVE_INTERVAL):
+        self.path = path
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # 键 -> 条目，越靠后越是最近用过的
+        self._next_key = 0
+        self._matrix = None             # 所有条目的单位化问题向量，条目有增删时重建
+        self._keys = []
+        self._load()
+        self.save_interval = save_interval
+        self._dirty = False
+        self._save_lock = threading.Lock()   # 保证按顺序写盘，旧的快照不会覆盖新的
+        self._stopped = threading.Event()
+        self._saver = threading.Thread(target=self._run_saver, name="answer-cache-saver", daemon=True)
+        self._saver.start()
+        atexit.register(self.close)
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "rb") as f:
+                entries = pickle.load(f)   # 本程序自己写出的文件，可以信任
+        except (OSError, pickle.UnpicklingError, EOFError) as e:
+            print(f"[答案缓存] 读取失败，从空缓存开始: {type(e).__name__}: {e}")
+            return
+        for entry in entries:
+            self._entries[self._next_key] = entry
+            self._next_key += 1
+
+    def _run_saver(self):
+        while not self._stopped.wait(self.save_interval):
+            self.flush()
+
+    def flush(self):
+        """有改动就写盘：锁里只复制条目列表（条目本身写入后不再修改），序列化和写文件都在锁外"""
+        with self._save_lock:
+            with self._lock:
+                if not self._dirty:
+                    return
+                entries = list(self._entries.values())
+                self._dirty = False
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    pickle.dump(entries, f)
+                os.replace(tmp, self.path)
+            except OSError as e:   # 写缓存失败不影响问答，下一轮再试
+                print(f"[答案缓存] 写入失败: {type(e).__name__}: {e}")
+                with self._lock:
+                    self._dirty = True
+
+    def close(self):
+        """停掉后台线程，把最后的改动写盘（程序退出时自动调用）"""
+        if self._saver.is_alive():
+            self._stopped.set()
+            self._saver.join()
+        self.flush()
+
+    def _search_matrix(self, vector):
+        if self._matrix is None:
+            self._keys = list(self._entries)
+            self._matrix = (np.array([self._entries[k]["vector"] for k in self._keys], dtype=np.float32)
+                            if self._keys else None)
+        if self._matrix is None:
+            return []
+        scores = self._matrix @ vector
+        order = np.argsort(-scores)
+        return [(self._keys[i], float(scores[i])) for i in order if scores[i] >= self.threshold]
+
+    def _remove(self, key):
+        del self._entries[key]
+        self._matrix = None
+
+    def get(self, query_vector, scope: dict, manifest: dict):
+        """找最相似且仍然有效的缓存回答，返回条目字典（query/answer/chunk_ids/similarity 等）或 None"""
+        vector = _normalize(query_vector)
+        scope_key = json.dumps(scope, sort_keys=True)
+        settings = _settings_key(manifest)
+        now = time.time()
+        with self._lock:
+            stale = []
+            found = None
+            for key, score in self._search_matrix(vector):
+                entry = self._entries[key]
+                if now - entry["created"] > self.ttl or entry["settings"] != settings \
+                        or not chunks_are_current(manifest, entry["chunk_ids"]):
+                    stale.append(key)   # 过期或依据的片段变了，顺手删掉
+                    continue
+                if entry["scope"] == scope_key:
+                    found = dict(entry, similarity=score)
+                    self._entries.move_to_end(key)
+                    break
+            for key in stale:
+                self._remove(key)
+            if stale:
+                self._dirty = True
+            if found is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return found
+
+    def put(self, query: str, query_vector, scope: dict, manifest: dict, answer: str, chunk_ids):
+        """记录一次 LLM 回答；没用到任何片段的回答不缓存（没法判断什么时候失效）"""
+        if not chunk_ids or not answer:
+            return
+        entry = {"query": query, "vector": _normalize(query_vector), "scope": json.dumps(scope, sort_keys=True),
+                 "settings": _settings_key(manifest), "answer": answer, "chunk_ids": list(chunk_ids),
+                 "created": time.time()}
+        with self._lock:
+            self._entries[self._next_key] = entry
+            self._next_key += 1
+            self._matrix = None
+            now = time.time()
+            for key in [k for k, e in self._entries.items() if now - e["created"] > self.ttl]:
+                self._remove(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+            self._dirty = True
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def _normalize(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    return vector / (np.linalg.norm(vector) + 1e-12)
@@ -0,0 +1,164 @@
+# RAG_demo/bench_retrieval.py
+# 检索基准测试：在 切分参数 × 索引类型 的组合上测构建耗时、索引大小、查询延迟和 recall@k
+# 只用本地 Embedding 模型，不调用 LLM，可以离线运行
+# 用法：python bench_retrieval.py queries.jsonl --chunk-sizes 500,800,1200 --overlaps 50,100 --index-types flat,hnsw
+#
+# 标注文件每行一个 JSON：{"question": "...", "source": "data/a.pdf", "page": 3, "text": "..."}
+# source / page / text 至少写一个，检索到的片段同时满足写了的条件就算命中：
+#   source  片段来自这个文件；page  片段在这一页（从1开始，和PDF阅读器一致）；text  片段包含这段原文
+import os
+import glob
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+from langchain_community.embeddings import HuggingFaceEmbeddings
+from embedding_cache import CachedEmbeddings
+from retriever import load_or_build_index
+from docstore import MmapDocstore
+
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+def read_labels(path: str):
+    labels = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                if not any(key in item for key in ("source", "page", "text")):
+                    raise ValueError(f"标注缺少 source/page/text: {item['question']}")
+                labels.append(item)
+    return labels
+
+
+def normalize(text: str) -> str:
+    return "".join(text.split())
+
+
+def is_relevant(doc, label: dict) -> bool:
+    if "source" in label and os.path.normpath(doc.metadata.get("source", "")) != os.path.normpath(label["source"]):
+        return False
+    if "page" in label and doc.metadata.get("page") != label["page"] - 1:   # PyPDFLoader 的页码从0开始
+        return False
+    if "text" in label and normalize(label["text"]) not in normalize(doc.page_content):
+        return False
+    return True
+
+
+def dir_size(path: str) -> int:
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(path) for name in names)
+
+
+def run_config(pdf_paths, embeddings, labels, chunk_size: int, chunk_overlap: int, index_type: str,
+               storage: str, ks, hybrid: bool) -> dict:
+    """在临时目录里构建一份索引，重新加载（和正式运行一样走 mmap）后逐条查询"""
+    with tempfile.TemporaryDirectory(prefix="rag_bench_") as index_dir:
+        index_config = {"type": index_type, "storage": storage}
+        start = time.perf_counter()
+        load_or_build_index(pdf_paths, embeddings, EMBEDDING_MODEL, chunk_size=chunk_size,
+                            chunk_overlap=chunk_overlap, index_dir=index_dir, index_config=index_config)
+        build_time = time.perf_counter() - start
+        rag_index = load_or_build_index(pdf_paths, embeddings, EMBEDDING_MODEL, chunk_size=chunk_size,
+                                        chunk_overlap=chunk_overlap, index_dir=index_dir,
+                                        index_config=index_config)
+        size = dir_size(index_dir)
+
+        max_k = max(ks)
+        questions = [label["question"] for label in labels]
+        # 预热：查询向量先算一遍进缓存，下面测的延迟只包含检索本身，各组合之间可比
+        rag_index.search_batch(questions, k=max_k, hybrid=hybrid)
+        latencies, hits = [], {k: 0 for k in ks}
+        for label in labels:
+            start = time.perf_counter()
+            docs = rag_index.search(label["question"], k=max_k, hybrid=hybrid)
+            latencies.append(time.perf_counter() - start)
+            first_hit = next((rank for rank, doc in enumerate(docs, start=1) if is_relevant(doc, label)), None)
+            for k in ks:
+                if first_hit is not None and first_hit <= k:
+                    hits[k] += 1
+
+        latencies_ms = np.array(latencies) * 1000
+        result = {
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+            "index_type": index_type,
+            "storage": storage,
+            "factory": rag_index.manifest["index"]["factory"],
+            "num_chunks": rag_index.manifest["num_chunks"],
+            "build_time": build_time,
+            "index_bytes": size,
+            "p50_ms": float(np.percentile(latencies_ms, 50)),
+            "p95_ms": float(np.percentile(latencies_ms, 95)),
+            "p99_ms": float(np.percentile(latencies_ms, 99)),
+            "recall": {k: hits[k] / len(labels) for k in ks},
+        }
+        # 删临时目录之前先释放正文和索引文件的映射，否则 Windows 下删不掉，后面的组合都跑不了
+        if isinstance(rag_index.vectorstore.docstore, MmapDocstore):
+            rag_index.vectorstore.docstore.close()
+        del rag_index
+    return result
+
+
+def parse_list(text: str, cast=str):
+    return [cast(item) for item in text.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG 检索基准测试（不调用 LLM）")
+    parser.add_argument("labels", help="标注好的查询集（JSONL）")
+    parser.add_argument("--data", default=os.path.join("data", "*.pdf"), help="语料文件的 glob")
+    parser.add_argument("--chunk-sizes", default="800", help="逗号分隔，如 500,800,1200")
+    parser.add_argument("--overlaps", default="100", help="逗号分隔，如 50,100")
+    parser.add_argument("--index-types", default="flat", help="逗号分隔：flat,ivf,hnsw,ivfpq")
+    parser.add_argument("--storage", default="fp32", help="逗号分隔：fp32,fp16,int8")
+    parser.add_argument("-k", default="1,3,5,10", help="计算 recall@k 的 k，逗号分隔")
+    parser.add_argument("--dense", action="store_true", help="只测向量检索（默认向量+BM25混合）")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="不使用向量缓存（构建耗时包含向量化，默认用缓存，第一组之后只测建索引本身）")
+    parser.add_argument("-o", "--output", help="把每组结果写到 JSONL 文件")
+    args = parser.parse_args()
+
+    pdf_paths = sorted(glob.glob(args.data))
+    if not pdf_paths:
+        print("警告：未找到任何PDF文件")
+        exit(1)
+    labels = read_labels(args.labels)
+    ks = sorted(parse_list(args.k, int))
+
+    embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL)
+    if not args.no_cache:
+        embeddings = CachedEmbeddings(embeddings, EMBEDDING_MODEL, symmetric=True)
+
+    results = []
+    for chunk_size in parse_list(args.chunk_sizes, int):
+        for chunk_overlap in parse_list(args.overlaps, int):
+            if chunk_overlap >= chunk_size:
+                continue
+            for index_type in parse_list(args.index_types):
+                for storage in parse_list(args.storage):
+                    print(f"\n[基准] chunk_size={chunk_size}, overlap={chunk_overlap}, "
+                          f"index={index_type}, storage={storage}")
+                    results.append(run_config(pdf_paths, embeddings, labels, chunk_size, chunk_overlap,
+                                              index_type, storage, ks, not args.dense))
+
+    print(f"\n{len(labels)} 条查询，{len(pdf_paths)} 个文件，检索方式：{'向量' if args.dense else '混合'}")
+    header = (f"{'chunk':>6} {'overlap':>7} {'index':<18} {'chunks':>6} {'build_s':>7} {'size_MB':>7} "
+              f"{'p50ms':>7} {'p95ms':>7} {'p99ms':>7} " + " ".join(f"{'R@' + str(k):>6}" for k in ks))
+    print(header)
+    for r in results:
+        print(f"{r['chunk_size']:>6} {r['chunk_overlap']:>7} {r['factory']:<18} {r['num_chunks']:>6} "
+              f"{r['build_time']:>7.2f} {r['index_bytes'] / 1e6:>7.2f} "
+              f"{r['p50_ms']:>7.2f} {r['p95_ms']:>7.2f} {r['p99_ms']:>7.2f} "
+              + " ".join(f"{r['recall'][k]:>6.2f}" for k in ks))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            for r in results:
+                f.write(json.dumps(r, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
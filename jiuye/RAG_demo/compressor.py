@@ -0,0 +1,64 @@
+# RAG_demo/compressor.py
+# 抽取式上下文压缩：把检索到的片段拆成句子，用已加载的 Embedding 模型给句子和问题算相似度，
+# 只保留最相关的句子，减少发给 LLM 的输入 token（纯 CPU，不调用 LLM）
+import re
+import numpy as np
+from generator import count_tokens
+
+COMPRESS_TOKEN_BUDGET = 600   # 压缩后检索内容最多多少 token
+MIN_SENTENCE_CHARS = 4        # 太短的句子（页码、编号残片）不参与打分
+
+
+def split_sentences(text: str):
+    """中文句末标点、问号叹号分号、换行处切分（标点留在句子里）"""
+    sentences = []
+    for part in re.split(r"(?<=[。！？；!?;\n])", text):
+        # 英文句号不能直接当边界（小数、缩写），只在后面跟空白时切
+        sentences.extend(s for s in re.split(r"(?<=\.)\s+", part) if s.strip())
+    return sentences
+
+
+def compress_context(query: str, packed, embeddings, budget: int = COMPRESS_TOKEN_BUDGET):
+    """packed 是 [(片段, 文本)]（pack_context 的结果），返回 ([(片段, 压缩后的文本)], 压缩前token数, 压缩后token数)
+
+    所有句子一次批量向量化，和问题向量算余弦相似度，按分数从高到低选句子直到用完预算；
+    每个片段里选中的句子按原顺序拼回去，中间跳过的部分用“……”表示。一个句子都没选中的片段整个丢掉。
+    """
+    sentences = []   # (片段序号, 句内序号, 句子)
+    for i, (_, text) in enumerate(packed):
+        for j, sentence in enumerate(split_sentences(text)):
+            if len(sentence.strip()) >= MIN_SENTENCE_CHARS:
+                sentences.append((i, j, sentence))
+    before = sum(count_tokens(text) for _, text in packed)
+    if not sentences:
+        return packed, before, before
+
+    vectors = np.array(embeddings.embed_documents([s for _, _, s in sentences]), dtype=np.float32)
+    query_vector = np.array(embeddings.embed_query(query), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    query_vector /= np.linalg.norm(query_vector) + 1e-12
+    scores = vectors @ query_vector
+
+    kept, used = set(), 0
+    for idx in np.argsort(-scores):
+        tokens = count_tokens(sentences[idx][2])
+        if used + tokens > budget:
+            continue
+        kept.add(int(idx))
+        used += tokens
+
+    compressed = []
+    for i, (doc, _) in enumerate(packed):
+        parts, last_j = [], None
+        for _, j, sentence in (sentences[idx] for idx in sorted(kept) if sentences[idx][0] == i):
+            if last_j is not None and j != last_j + 1:
+                parts.append("……")
+            parts.append(sentence.strip())
+            last_j = j
+        if parts:
+            compressed.append((doc, "".join(parts) if _is_cjk(parts[0]) else " ".join(parts)))
+    return compressed, before, used
+
+
+def _is_cjk(text: str) -> bool:
+    return any("\u4e00" <= ch <= "\u9fff" for ch in text)
@@ -0,0 +1,155 @@
+# RAG_demo/dedup.py
+# 近似重复片段去重：切分之后、向量化之前，用 MinHash + LSH 找出和已有片段几乎一样的片段（修订版、页眉页脚、
+# 重复的法律条款等），只保留第一次出现的那个（规范片段），其余的只记下出处，不向量化、不进索引
+import os
+import re
+import zlib
+from collections import defaultdict
+import numpy as np
+
+DEDUP_THRESHOLD = 0.85   # 字符5-gram 的 Jaccard 相似度（MinHash 估计值）达到这个值就算重复
+SHINGLE_SIZE = 5         # 按字符切 n-gram，中英文都适用
+NUM_PERM = 64            # MinHash 签名长度
+BANDS = 8                # LSH 分段数，每段 NUM_PERM // BANDS 个值；相似度约 0.77 以上的片段大概率落进同一个桶
+LSH_FILE = "dedup_lsh.npz"   # 规范片段的签名单独存放，只有增量更新时才需要
+
+_PRIME = np.uint64(4294967291)   # 小于 2^32 的最大素数
+_rng = np.random.RandomState(1)  # 固定种子：签名要跨进程、跨运行保持一致（会随索引落盘）
+_A = _rng.randint(1, 1 << 31, size=NUM_PERM, dtype=np.uint64)
+_B = _rng.randint(0, 1 << 32, size=NUM_PERM, dtype=np.uint64)
+
+
+def shingles(text: str) -> np.ndarray:
+    """去掉大小写和空白差异后切字符 n-gram，返回各 n-gram 的 crc32"""
+    text = re.sub(r"\s+", " ", text.lower()).strip()
+    if len(text) <= SHINGLE_SIZE:
+        grams = {text}
+    else:
+        grams = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    return np.fromiter((zlib.crc32(g.encode("utf-8")) for g in grams), dtype=np.uint64, count=len(grams))
+
+
+def minhash(text: str) -> np.ndarray:
+    hashes = shingles(text)
+    # (a*x + b) mod p，x < 2^32、a < 2^31，不会超出 uint64
+    return ((np.outer(hashes, _A) + _B) % _PRIME).min(axis=0).astype(np.uint32)
+
+
+class ChunkDeduplicator:
+    """规范片段的 MinHash 签名和 LSH 桶，以及每个规范片段的重复出处；随索引一起保存
+
+    canonical_of 记录 重复片段ID -> 规范片段ID，检索结果里规范片段的 metadata["dup_sources"]
+    列出所有重复出处，按文件/页码限定范围检索时重复片段也能通过它找到规范片段。
+    检索只用得到 canonical_of 和 duplicates，它们存在 dedup.pkl 里；签名存在 dedup_lsh.npz（LSH 桶由签名重建），
+    语料很大时有几百MB，只在 filter / remove（增量更新）第一次用到时才从 attach() 指定的目录加载。
+    """
+    def __init__(self, threshold: float = DEDUP_THRESHOLD):
+        self.threshold = threshold
+        self.signatures = {}                 # 规范片段ID -> 签名
+        self.buckets = defaultdict(set)      # (段号, 段内容) -> 规范片段ID
+        self.duplicates = defaultdict(list)  # 规范片段ID -> [{"id", "source", "page"}]
+        self.canonical_of = {}               # 重复片段ID -> 规范片段ID
+        self._lsh_path = None
+
+    def __getstate__(self):
+        # dedup.pkl 只存检索要用的部分，签名见 save_lsh
+        return {"threshold": self.threshold, "duplicates": self.duplicates, "canonical_of": self.canonical_of}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.signatures = None   # 用到时再加载
+        self.buckets = None
+        self._lsh_path = None
+
+    def attach(self, directory: str):
+        """从 dedup.pkl 加载后调用，记下签名文件的位置"""
+        self._lsh_path = os.path.join(directory, LSH_FILE)
+
+    def save_lsh(self, directory: str):
+        """签名写到 dedup_lsh.npz（先写临时文件再替换）；没加载过签名说明没有变化，磁盘上的文件仍然有效"""
+        if self.signatures is None:
+            return
+        path = os.path.join(directory, LSH_FILE)
+        ids = list(self.signatures)
+        matrix = np.array([self.signatures[cid] for cid in ids], dtype=np.uint32).reshape(len(ids), NUM_PERM)
+        # 片段ID用换行拼成一段 UTF-8（定长字符串数组会按最长的ID给每个ID留空间）
+        id_bytes = np.frombuffer("\n".join(ids).encode("utf-8"), dtype=np.uint8)
+        with open(path + ".tmp", "wb") as f:
+            np.savez(f, ids=id_bytes, signatures=matrix)
+        os.replace(path + ".tmp", path)
+
+    def _ensure_lsh(self):
+        if self.signatures is not None:
+            return
+        with np.load(self._lsh_path) as data:
+            ids = data["ids"].tobytes().decode("utf-8").split("\n") if data["ids"].size else []
+            matrix = data["signatures"]
+        self.signatures = {}
+        self.buckets = defaultdict(set)
+        for cid, signature in zip(ids, matrix):
+            self.signatures[cid] = signature
+            for key in self._bands(signature):
+                self.buckets[key].add(cid)
+
+    def _bands(self, signature: np.ndarray):
+        rows = NUM_PERM // BANDS
+        return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(BANDS)]
+
+    def find(self, signature: np.ndarray):
+        """已有的最相似的规范片段ID（相似度要达到阈值），没有返回 None"""
+        best, best_score = None, self.threshold
+        for cid in set().union(*(self.buckets.get(key, ()) for key in self._bands(signature))):
+            score = float(np.mean(self.signatures[cid] == signature))
+            if score >= best_score:
+                best, best_score = cid, score
+        return best
+
+    def filter(self, docs, ids):
+        """一批片段里挑出需要向量化的规范片段，返回 (片段, 片段ID)；重复的只记录出处
+
+        同一批里的片段也互相比较，所以结果和批大小无关。
+        """
+        self._ensure_lsh()
+        kept_docs, kept_ids = [], []
+        for doc, cid in zip(docs, ids):
+            signature = minhash(doc.page_content)
+            canonical = self.find(signature)
+            if canonical is None:
+                self.signatures[cid] = signature
+                for key in self._bands(signature):
+                    self.buckets[key].add(cid)
+                kept_docs.append(doc)
+                kept_ids.append(cid)
+            else:
+                self.duplicates[canonical].append(
+                    {"id": cid, "source": doc.metadata.get("source"), "page": doc.metadata.get("page")})
+                self.canonical_of[cid] = canonical
+        return kept_docs, kept_ids
+
+    def sources_of(self, chunk_id: str):
+        return [{"source": d["source"], "page": d["page"]} for d in self.duplicates.get(chunk_id, ())]
+
+    def dependents(self, chunk_ids):
+        """这些规范片段被删掉后失去规范片段的重复片段所在的文件（需要重新导入）"""
+        return {d["source"] for cid in chunk_ids for d in self.duplicates.get(cid, ())}
+
+    def remove(self, chunk_ids):
+        """删除片段（规范的和重复的都可以），文件修改或删除时调用"""
+        self._ensure_lsh()
+        for cid in chunk_ids:
+            canonical = self.canonical_of.pop(cid, None)
+            if canonical is not None:
+                self.duplicates[canonical] = [d for d in self.duplicates[canonical] if d["id"] != cid]
+                if not self.duplicates[canonical]:
+                    del self.duplicates[canonical]
+                continue
+            signature = self.signatures.pop(cid, None)
+            if signature is None:
+                continue
+            for key in self._bands(signature):
+                self.buckets[key].discard(cid)
+                if not self.buckets[key]:
+                    del self.buckets[key]
+            # 剩下的重复出处交给调用方重新导入，这里只断开关系
+            for d in self.duplicates.pop(cid, ()):
+                self.canonical_of.pop(d["id"], None)
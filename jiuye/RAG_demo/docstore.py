@@ -0,0 +1,91 @@
+# RAG_demo/docstore.py
+# 片段正文放在磁盘数据文件里按偏移量读取，不再以 Python 对象的形式常驻内存
+import os
+import json
+import mmap
+import threading
+from langchain_community.docstore.base import AddableMixin, Docstore
+from langchain_core.documents import Document
+
+
+class MmapDocstore(Docstore, AddableMixin):
+    """追加式数据文件 + 偏移表的 docstore，读取走 mmap
+
+    每个片段序列化成一段 JSON 追加到数据文件，内存里只保留 id -> (偏移, 长度)。
+    多个进程加载同一份索引时共享操作系统的页缓存。删除只去掉偏移表里的记录，
+    数据文件里的旧内容等下次全量重建时丢弃。
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.offsets = {}
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        # 随 index.pkl 一起落盘的只有文件名和偏移表
+        return {"path": os.path.basename(self.path), "offsets": self.offsets}
+
+    def __setstate__(self, state):
+        self.path = state["path"]
+        self.offsets = state["offsets"]
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def attach(self, directory: str):
+        """从 index.pkl 加载后调用，把数据文件定位到索引目录下并立即映射
+
+        立即映射是为了占住这个文件：别的进程全量重建后会删掉旧的数据文件，
+        已经映射的进程还能继续读（Linux 下删除只是去掉目录项，Windows 下删不掉会留到下次）。
+        """
+        self.path = os.path.join(directory, os.path.basename(self.path))
+        if os.path.getsize(self.path) > 0:
+            with self._lock:
+                self._remap()
+
+    def _remap(self):
+        if self._mm is not None:
+            self._mm.close()
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def add(self, texts: dict) -> None:
+        overlapping = set(texts).intersection(self.offsets)
+        if overlapping:
+            raise ValueError(f"Tried to add ids that already exist: {overlapping}")
+        with self._lock:
+            with open(self.path, "ab") as f:
+                f.seek(0, os.SEEK_END)
+                for doc_id, doc in texts.items():
+                    data = json.dumps({"text": doc.page_content, "metadata": doc.metadata},
+                                      ensure_ascii=False).encode("utf-8")
+                    self.offsets[doc_id] = (f.tell(), len(data))
+                    f.write(data)
+
+    def delete(self, ids: list) -> None:
+        missing = set(ids).difference(self.offsets)
+        if missing:
+            raise ValueError(f"Tried to delete ids that does not exist: {missing}")
+        for doc_id in ids:
+            self.offsets.pop(doc_id)
+
+    def close(self) -> None:
+        """释放 mmap（Windows 下文件被映射时删不掉）；之后再读取会重新映射"""
+        with self._lock:
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+
+    def _read(self, offset: int, length: int) -> bytes:
+        """从 mmap 里取一段数据；文件追加过内容、映射范围不够时重新映射"""
+        with self._lock:
+            if self._mm is None or len(self._mm) < offset + length:
+                self._remap()
+            return self._mm[offset:offset + length]
+
+    def search(self, search: str):
+        location = self.offsets.get(search)
+        if location is None:
+            return f"ID {search} not found."
+        offset, length = location
+        record = json.loads(self._read(offset, length).decode("utf-8"))
+        return Document(page_content=record["text"], metadata=record["metadata"])
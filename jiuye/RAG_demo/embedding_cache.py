@@ -0,0 +1,179 @@
+# RAG_demo/embedding_cache.py
+# 按 (模型名, 文本哈希) 缓存向量，rag_demo.py / rag_multi.py 共用同一份缓存
+import os
+import re
+import json
+import hashlib
+import threading
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+EMB_CACHE_DIR = "emb_cache"
+KEY_BYTES = 16   # blake2b-128 作为文本指纹
+READ_ROWS = 16384     # 建键索引时每次映射这么多条记录，只取键，用完就解除映射
+MERGE_ROWS = 50000    # 新增的键在字典里攒到这么多条，就并进有序数组
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=KEY_BYTES).digest()
+
+
+class EmbeddingStore:
+    """定长记录的追加式向量文件：每条记录 = 16字节文本哈希 + 向量(float16/float32)
+
+    只追加不修改，多个进程同时写也不会互相覆盖；读向量走 np.memmap，不整体读进内存。
+    键索引是按键排序的定长数组（每条 16 字节键 + 8 字节行号，查找用二分），加上一个放最近新增键的小字典；
+    启动时分段映射文件只取键，不读向量，几十万条缓存也只占几MB内存。
+    """
+    def __init__(self, directory: str, dtype: str = "float16"):
+        self.directory = directory
+        self.dtype = np.dtype(dtype)
+        self.path = os.path.join(directory, f"vectors_{self.dtype.name}.bin")
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.dim = None
+        self.rows = {}            # 最近新增的 文本哈希 -> 行号，攒够 MERGE_ROWS 条并进下面的有序数组
+        self._sorted_keys = np.empty(0, dtype=f"S{KEY_BYTES}")
+        self._sorted_rows = np.empty(0, dtype=np.int64)
+        self._known_bytes = 0     # 已经建立索引的文件长度
+        self._vectors = None      # 当前的 memmap 视图
+        self._lock = threading.Lock()
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, "r", encoding="utf-8") as f:
+                self.dim = json.load(f)["dim"]
+            self._refresh()
+
+    @property
+    def record_dtype(self):
+        # 用 void 而不是 S 类型：S 类型转回 bytes 时会吃掉末尾的 \0
+        return np.dtype([("key", f"V{KEY_BYTES}"), ("vec", self.dtype, (self.dim,))])
+
+    def _refresh(self):
+        """把文件里新增的记录（自己或其他进程写入的）补进哈希表"""
+        if self.dim is None or not os.path.exists(self.path):
+            return
+        rec = self.record_dtype
+        size = os.path.getsize(self.path) // rec.itemsize * rec.itemsize  # 忽略写了一半的尾部
+        if size > self._known_bytes:
+            start_row = self._known_bytes // rec.itemsize
+            end_row = size // rec.itemsize
+            new_keys = []
+            for first in range(start_row, end_row, READ_ROWS):
+                count = min(READ_ROWS, end_row - first)
+                window = np.memmap(self.path, dtype=rec, mode="r", offset=first * rec.itemsize, shape=(count,))
+                new_keys.append(np.ascontiguousarray(window["key"]).view(f"S{KEY_BYTES}"))
+                del window
+            new_keys = np.concatenate(new_keys)
+            if len(self.rows) + len(new_keys) >= MERGE_ROWS:
+                self._merge(new_keys, np.arange(start_row, end_row, dtype=np.int64))
+            else:
+                keys = new_keys.view(f"V{KEY_BYTES}").tolist()
+                for i, (key, known) in enumerate(zip(keys, self._find(keys)), start=start_row):
+                    if known is None:
+                        self.rows.setdefault(key, i)
+            self._known_bytes = size
+            self._vectors = np.memmap(self.path, dtype=rec, mode="r", shape=(end_row,))["vec"]
+
+    def _merge(self, new_keys, new_rows):
+        """字典和新读到的键一起并进有序数组；同一个键出现多次时保留最早的行（稳定排序 + 左侧二分）"""
+        if self.rows:
+            new_keys = np.concatenate([np.array(list(self.rows), dtype=f"V{KEY_BYTES}").view(f"S{KEY_BYTES}"),
+                                       new_keys])
+            new_rows = np.concatenate([np.fromiter(self.rows.values(), dtype=np.int64, count=len(self.rows)),
+                                       new_rows])
+            self.rows = {}
+        keys = np.concatenate([self._sorted_keys, new_keys])
+        rows = np.concatenate([self._sorted_rows, new_rows])
+        order = np.lexsort((rows, keys))
+        self._sorted_keys, self._sorted_rows = keys[order], rows[order]
+
+    def _find(self, keys):
+        """在有序数组里二分查找，返回每个键的行号（没有为 None）"""
+        if not len(self._sorted_keys) or not keys:
+            return [None] * len(keys)
+        query = np.array(keys, dtype=f"V{KEY_BYTES}").view(f"S{KEY_BYTES}")
+        pos = np.searchsorted(self._sorted_keys, query)
+        pos = np.minimum(pos, len(self._sorted_keys) - 1)
+        hit = self._sorted_keys[pos] == query
+        return [int(self._sorted_rows[p]) if h else None for p, h in zip(pos.tolist(), hit.tolist())]
+
+    def _lookup(self, keys):
+        rows = self._find(keys)
+        return [self.rows.get(key, row) if row is None else row for key, row in zip(keys, rows)]
+
+    def get_many(self, keys):
+        """返回 {哈希: float32向量}，不在缓存里的键不出现在结果中"""
+        with self._lock:
+            found = {}
+            rows = self._lookup(keys)
+            if any(row is None for row in rows):
+                self._refresh()
+                rows = self._lookup(keys)
+            for key, row in zip(keys, rows):
+                if row is not None:
+                    found[key] = np.asarray(self._vectors[row], dtype=np.float32)
+            return found
+
+    def put_many(self, keys, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self.meta_path, "w", encoding="utf-8") as f:
+                    json.dump({"dim": self.dim}, f)
+            records = np.empty(len(keys), dtype=self.record_dtype)
+            records["key"] = keys
+            records["vec"] = vectors
+            # 一次 write 写完整批记录，追加模式下不会和其他进程的写入交错
+            with open(self.path, "ab") as f:
+                f.write(records.tobytes())
+            self._refresh()
+
+
+class CachedEmbeddings(Embeddings):
+    """带本地缓存的 Embeddings 包装：先查缓存，只把没见过的文本交给模型"""
+    def __init__(self, base: Embeddings, model_name: str, cache_dir: str = EMB_CACHE_DIR,
+                 dtype: str = "float16", symmetric: bool = False):
+        self.base = base
+        self.model_name = model_name
+        # 查询和文档编码方式相同的模型（如 MiniLM），批量查询可以直接走 embed_documents 一次算完
+        self.symmetric = symmetric
+        slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", model_name)
+        self.store = EmbeddingStore(os.path.join(cache_dir, slug), dtype)
+        self.hits = 0
+        self.misses = 0
+
+    def _embed_cached(self, keys, texts, compute):
+        """按键查缓存，未命中的文本整批交给 compute 计算后写回"""
+        found = self.store.get_many(keys)
+
+        # 同一批里重复的文本只算一次
+        todo = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in todo:
+                todo[key] = text
+        self.hits += len(texts) - len(todo)
+        self.misses += len(todo)
+        if todo:
+            vectors = compute(list(todo.values()))
+            self.store.put_many(list(todo), vectors)
+            found.update(self.store.get_many(list(todo)))
+        # 统一从缓存取，保证首次运行和之后运行拿到的向量完全一致（同样的精度）
+        return [found[key].tolist() for key in keys]
+
+    def embed_documents(self, texts):
+        return self._embed_cached([text_key(t) for t in texts], texts, self.base.embed_documents)
+
+    def embed_query(self, text: str):
+        return self.embed_queries([text])[0]
+
+    def embed_queries(self, texts):
+        """批量计算查询向量（批量问答用）：未命中的查询一次交给模型，而不是逐条调用 embed_query"""
+        keys = [text_key("\0query\0" + t) for t in texts]  # 有些模型查询和文档的编码方式不同，分开存
+        if len(texts) == 1:
+            return self._embed_cached(keys, texts, lambda todo: [self.base.embed_query(todo[0])])
+        if self.symmetric:
+            compute = self.base.embed_documents
+        else:
+            compute = lambda todo: [self.base.embed_query(t) for t in todo]
+        return self._embed_cached(keys, texts, compute)
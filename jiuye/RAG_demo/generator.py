@@ -1 +1,205 @@
-#wait for sometime to rebuild ,not now.
\ No newline at end of file
+# RAG_demo/generator.py
+# 提示词组装（按 token 预算挑选检索到的片段，去掉切分重叠带来的重复内容）和 LLM 调用
+import time
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:  # 没装 tiktoken 或下载不了词表时用估算
+    _encoding = None
+
+CONTEXT_TOKEN_BUDGET = 2000   # 拼进 prompt 的检索内容最多多少 token
+MIN_OVERLAP = 20              # 首尾重合至少这么多字符才当作切分重叠处理
+
+# DeepSeek 定价（与 Agent_demo/agent_demo.py 一致），输入命中服务端前缀缓存时只收十分之一
+DEEPSEEK_PRICING = {
+    "input_cached": 0.2 / 1_000_000,     # 0.2元/百万tokens（缓存命中）
+    "input_uncached": 2.0 / 1_000_000,   # 2元/百万tokens（缓存未命中）
+    "output": 3.0 / 1_000_000             # 3元/百万tokens
+}
+
+# 固定不变的系统提示词放在最前面，每次请求的开头都一样，才能命中 DeepSeek 的前缀缓存
+SYSTEM_PROMPT = "你是一个文档问答助手。请只根据用户提供的文档内容回答问题，文档中没有的信息请直接说明。"
+
+
+def count_tokens(text: str) -> int:
+    """tiktoken 计数；不可用时按 DeepSeek 文档的经验值估算（中文约0.6、英文约0.3 token/字符）"""
+    if _encoding is not None:
+        return len(_encoding.encode(text, disallowed_special=()))
+    cjk = sum(1 for ch in text if "\u4e00" <= ch <= "\u9fff")
+    return int(cjk * 0.6 + (len(text) - cjk) * 0.3) + 1
+
+
+class TokenCounter:
+    """按片段ID缓存 token 数，同一个片段只计数一次"""
+    def __init__(self, max_entries: int = 50000):
+        self.cache = {}
+        self.max_entries = max_entries
+
+    def __call__(self, doc) -> int:
+        key = getattr(doc, "id", None) or doc.page_content
+        n = self.cache.get(key)
+        if n is None:
+            n = count_tokens(doc.page_content)
+            if len(self.cache) >= self.max_entries:
+                self.cache.clear()
+            self.cache[key] = n
+        return n
+
+
+token_counter = TokenCounter()
+
+
+def overlap_len(a: str, b: str, max_len: int = 400) -> int:
+    """a 的结尾与 b 的开头重合的最长长度（不足 MIN_OVERLAP 记为0）"""
+    for n in range(min(len(a), len(b), max_len), MIN_OVERLAP - 1, -1):
+        if a.endswith(b[:n]):
+            return n
+    return 0
+
+
+def pack_context(docs, budget: int = CONTEXT_TOKEN_BUDGET, counter: TokenCounter = token_counter):
+    """按检索排名依次装入片段，直到用完 token 预算
+
+    完全重复/被包含的片段直接丢掉；同一文件里首尾相接的片段去掉重叠部分再计数。
+    装不下的片段跳过，继续尝试后面更短的。返回 ([(片段, 实际使用的文本)], 使用的token数)。
+    """
+    packed, used = [], 0
+    for doc in docs:
+        text = doc.page_content.strip()
+        source = doc.metadata.get("source")
+        trimmed = False
+        for _, kept in ((d, t) for d, t in packed if d.metadata.get("source") == source):
+            if text in kept:
+                text = ""
+                break
+            n = overlap_len(kept, text)
+            if n:
+                text, trimmed = text[n:], True
+            n = overlap_len(text, kept)
+            if n:
+                text, trimmed = text[:-n], True
+        # 去掉重叠后只剩零碎几个字的不要；本来就很短的片段（规格参数、短页面）照常装入
+        if not text.strip() or (trimmed and len(text.strip()) < MIN_OVERLAP):
+            continue
+        tokens = count_tokens(text) if trimmed else counter(doc)
+        if used + tokens > budget:
+            continue
+        packed.append((doc, text))
+        used += tokens
+    return packed, used
+
+
+def chunk_order_key(doc):
+    """按 文件、页码、片段序号 排序，和检索分数无关"""
+    cid = getattr(doc, "id", None) or ""
+    index = cid.rsplit("#", 1)[-1]
+    return (doc.metadata.get("source", ""), doc.metadata.get("page", -1), int(index) if index.isdigit() else -1)
+
+
+def build_messages(query: str, packed):
+    """前缀缓存友好的消息布局：固定的系统提示词 → 按文档位置排序的片段 → 问题放最后
+
+    同一批片段不管检索分数怎么排，拼出来的文本都一样；问题放在最后，
+    追问同一份资料时前面的系统提示词和文档内容都能命中缓存。
+    """
+    context = "\n".join(text for _, text in sorted(packed, key=lambda item: chunk_order_key(item[0])))
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"以下是相关文档内容：\n{context}\n\n请根据这些内容回答问题：{query}"},
+    ]
+
+
+def _as_messages(prompt):
+    return prompt if isinstance(prompt, list) else [{"role": "user", "content": prompt}]
+
+
+def ask_llm(client, prompt, stream: bool = True):
+    """用 DeepSeek 回答问题，并统计 token 消耗和耗时
+
+    prompt 可以是字符串，也可以是 build_messages 生成的消息列表。
+    stream=True 时边生成边打印（前面带“回答:”），并记录首字延迟（ttft）；
+    usage 通过 stream_options 在最后一个数据块里返回，统计口径和非流式一致。
+    返回 (回答, 统计信息字典)。
+    """
+    start = time.perf_counter()
+    ttft = None
+    usage = None
+    if stream:
+        response = client.chat.completions.create(
+            model="deepseek-chat",
+            messages=_as_messages(prompt),
+            stream=True,
+            stream_options={"include_usage": True},
+        )
+        parts = []
+        print("回答: ", end="", flush=True)
+        for chunk in response:
+            if chunk.usage:
+                usage = chunk.usage
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(delta)
+                print(delta, end="", flush=True)
+        print()
+        answer = "".join(parts)
+    else:
+        response = client.chat.completions.create(
+            model="deepseek-chat",
+            messages=_as_messages(prompt),
+            stream=False
+        )
+        usage = response.usage
+        answer = response.choices[0].message.content
+    total_time = time.perf_counter() - start
+
+    stats = usage_stats(usage, ttft, total_time)
+    if usage:
+        print(f"[统计] 输入tokens={stats['input_tokens']}, 输出tokens={stats['output_tokens']}, "
+              f"总tokens={stats['total_tokens']}, 缓存命中率={stats['cache_hit_rate']:.0%}, "
+              f"约花费={stats['cost']:.6f}元（缓存省了{stats['cache_savings']:.6f}元）, "
+              f"首字延迟={stats['ttft']:.2f}s, 总耗时={total_time:.2f}s")
+    return answer, stats
+
+
+def usage_stats(usage, ttft, total_time: float) -> dict:
+    """把接口返回的 usage 整理成统计信息字典
+
+    DeepSeek 在 usage 里额外返回 prompt_cache_hit_tokens / prompt_cache_miss_tokens，
+    命中部分按缓存价计费；没有这两个字段时全部按未命中计。
+    """
+    # 默认值
+    stats = {"input_tokens": 0, "output_tokens": 0, "total_tokens": 0, "cost": 0.0,
+             "cache_hit_tokens": 0, "cache_hit_rate": 0.0, "cache_savings": 0.0,
+             "ttft": ttft if ttft is not None else total_time, "total_time": total_time}
+
+    # 统计 token 消耗
+    if usage:
+        hit = getattr(usage, "prompt_cache_hit_tokens", None) or 0
+        miss = getattr(usage, "prompt_cache_miss_tokens", None)
+        if miss is None:
+            miss = usage.prompt_tokens - hit
+        stats["input_tokens"] = usage.prompt_tokens
+        stats["output_tokens"] = usage.completion_tokens
+        stats["total_tokens"] = usage.total_tokens
+        stats["cache_hit_tokens"] = hit
+        stats["cache_hit_rate"] = hit / usage.prompt_tokens if usage.prompt_tokens else 0.0
+        stats["cost"] = (hit * DEEPSEEK_PRICING["input_cached"] + miss * DEEPSEEK_PRICING["input_uncached"]
+                         + usage.completion_tokens * DEEPSEEK_PRICING["output"])
+        stats["cache_savings"] = hit * (DEEPSEEK_PRICING["input_uncached"] - DEEPSEEK_PRICING["input_cached"])
+    return stats
+
+
+async def ask_llm_async(aclient, prompt):
+    """ask_llm 的异步非流式版本（批量问答用，AsyncOpenAI 客户端），不打印，返回 (回答, 统计信息字典)"""
+    start = time.perf_counter()
+    response = await aclient.chat.completions.create(
+        model="deepseek-chat",
+        messages=_as_messages(prompt),
+        stream=False
+    )
+    total_time = time.perf_counter() - start
+    return response.choices[0].message.content, usage_stats(response.usage, None, total_time)
@@ -0,0 +1,84 @@
+# RAG_demo/index_factory.py
+# 可选的 FAISS 索引类型：flat 精确检索，ivf / hnsw / ivfpq 近似检索（语料越大越划算，但召回会略降）
+import faiss
+import numpy as np
+
+DEFAULT_INDEX_CONFIG = {
+    "type": "flat",        # flat / ivf / hnsw / ivfpq
+    "storage": "fp32",     # 向量存储精度 fp32 / fp16 / int8（标量量化，分别约省一半/四分之三内存；ivfpq 本身已压缩，忽略此项）
+    "docstore": "mmap",    # 片段正文 mmap（磁盘文件按偏移读取）/ memory（LangChain 默认的内存字典）
+    "nlist": 1024,         # IVF 聚类中心数
+    "pq_m": 16,            # PQ 子向量个数（向量维度必须能整除它，MiniLM 是384维）
+    "pq_nbits": 8,         # 每个子向量的编码位数
+    "hnsw_m": 32,          # HNSW 每个节点的邻居数
+    "train_size": 50000,   # IVF/PQ 训练用的样本数上限
+    # 下面两个是检索时参数，加载时生效，改了不需要重建索引
+    "nprobe": 16,          # IVF 检索时探查的聚类数，越大越准越慢
+    "ef_search": 64,       # HNSW 检索时的候选队列长度，越大越准越慢
+}
+SEARCH_PARAM_KEYS = ("nprobe", "ef_search")
+# 存储精度对应的 faiss 编码：fp32 不量化，fp16 半精度，int8 每维一个字节（需要训练取值范围）
+SQ_CODES = {"fp32": "Flat", "fp16": "SQfp16", "int8": "SQ8"}
+
+
+def resolve_config(index_config=None) -> dict:
+    config = dict(DEFAULT_INDEX_CONFIG)
+    config.update(index_config or {})
+    if config["type"] not in ("flat", "ivf", "hnsw", "ivfpq"):
+        raise ValueError(f"未知的索引类型: {config['type']}")
+    if config["storage"] not in SQ_CODES:
+        raise ValueError(f"未知的向量存储精度: {config['storage']}")
+    if config["docstore"] not in ("mmap", "memory"):
+        raise ValueError(f"未知的 docstore 类型: {config['docstore']}")
+    return config
+
+
+def build_params(config: dict) -> dict:
+    """影响索引结构的参数（参与指纹计算）；nprobe/ef_search 只影响检索，不参与"""
+    return {k: v for k, v in config.items() if k not in SEARCH_PARAM_KEYS}
+
+
+def needs_training(config: dict) -> bool:
+    return config["type"] in ("ivf", "ivfpq") or (config["type"] != "ivfpq" and config["storage"] == "int8")
+
+
+def factory_string(config: dict, dim: int, n_train: int) -> str:
+    """生成 faiss.index_factory 描述串；样本太少时自动缩小聚类数/编码位数，避免训练失败"""
+    kind = config["type"]
+    # faiss 建议每个聚类中心至少 39 个训练样本
+    nlist = max(1, min(config["nlist"], n_train // 39))
+    codes = SQ_CODES[config["storage"]]
+    if kind == "flat":
+        return codes
+    if kind == "ivf":
+        return f"IVF{nlist},{codes}"
+    if kind == "hnsw":
+        return f"HNSW{config['hnsw_m']}" + ("" if codes == "Flat" else f",{codes}")
+    if dim % config["pq_m"] != 0:
+        raise ValueError(f"向量维度 {dim} 不能被 pq_m={config['pq_m']} 整除")
+    nbits = max(1, min(config["pq_nbits"], int(np.log2(max(2, n_train // 39)))))
+    return f"IVF{nlist},PQ{config['pq_m']}x{nbits}"
+
+
+def create_index(config: dict, vectors: np.ndarray):
+    """按配置创建索引，需要训练的类型用 vectors 里随机抽的样本训练；返回 (索引, 描述串)"""
+    n, dim = vectors.shape
+    sample = vectors
+    if n > config["train_size"]:
+        rng = np.random.default_rng(0)   # 固定种子，同样的语料得到同样的索引
+        sample = vectors[rng.choice(n, config["train_size"], replace=False)]
+    spec = factory_string(config, dim, len(sample))
+    index = faiss.index_factory(dim, spec)
+    if not index.is_trained:
+        index.train(np.ascontiguousarray(sample, dtype=np.float32))
+    apply_search_params(index, config)
+    return index, spec
+
+
+def apply_search_params(index, config: dict):
+    """设置检索时参数（nprobe / efSearch），对不支持的索引类型不做处理"""
+    params = faiss.ParameterSpace()
+    if config["type"] in ("ivf", "ivfpq"):
+        params.set_index_parameter(index, "nprobe", config["nprobe"])
+    elif config["type"] == "hnsw":
+        params.set_index_parameter(index, "efSearch", config["ef_search"])
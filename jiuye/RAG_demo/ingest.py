@@ -0,0 +1,106 @@
+# RAG_demo/ingest.py
+# 按页范围并行解析PDF → 边到边切分 → 按批向量化，三个阶段重叠执行，内存占用只和批大小有关，和语料大小无关
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pypdf import PdfReader
+from langchain_core.documents import Document
+
+EMBED_BATCH_SIZE = 256   # 每批送去向量化的片段数
+PAGES_PER_TASK = 50      # 大PDF按这么多页一段拆成多个解析任务
+
+
+def iter_pages(path: str, start: int = 0, end: int = None):
+    """逐页解析，一次只有一页在内存里；文本提取方式和元数据与 PyPDFLoader 一致（source/page 从0开始）"""
+    reader = PdfReader(path)
+    total = len(reader.pages)
+    labels = reader.page_labels   # 每次访问都会重新计算整份列表，只取一次
+    for i in range(start, total if end is None else min(end, total)):
+        yield Document(page_content=reader.pages[i].extract_text().strip(),
+                       metadata={"source": path, "total_pages": total, "page": i, "page_label": labels[i]})
+
+
+def _parse_pages(path: str, start: int, end: int):
+    """在子进程里解析一个页范围；Document 可以 pickle 回主进程"""
+    return path, list(iter_pages(path, start, end))
+
+
+def page_tasks(paths, pages_per_task: int = PAGES_PER_TASK):
+    """把文件拆成 (路径, 起始页, 结束页) 任务，大文件也能分给多个进程"""
+    tasks = []
+    for path in paths:
+        total = len(PdfReader(path).pages)
+        tasks.extend((path, start, min(start + pages_per_task, total)) for start in range(0, total, pages_per_task))
+    return tasks
+
+
+def iter_parsed_pages(paths, max_workers=None, pages_per_task: int = PAGES_PER_TASK):
+    """产出 (路径, 若干页)，同一文件内按页码顺序
+
+    单进程时逐页惰性解析；多进程时按页范围分任务，在途任务数限制在进程数的两倍，
+    按提交顺序取结果，解析得再快也不会在内存里堆积。
+    """
+    paths = list(paths)
+    workers = max_workers or os.cpu_count() or 1
+    tasks = page_tasks(paths, pages_per_task) if workers > 1 else []
+    if len(tasks) <= 1:
+        for path in paths:
+            for page in iter_pages(path):
+                yield path, [page]
+        return
+
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+        pending = iter(tasks)
+        window = deque(pool.submit(_parse_pages, *task) for _, task in zip(range(2 * workers), pending))
+        while window:
+            path, pages = window.popleft().result()
+            task = next(pending, None)
+            if task is not None:
+                window.append(pool.submit(_parse_pages, *task))
+            yield path, pages
+
+
+def iter_chunk_batches(paths, text_splitter, make_id, per_file: dict,
+                       batch_size: int = EMBED_BATCH_SIZE, max_workers=None):
+    """解析出几页就立刻切分，攒够 batch_size 个片段产出一批 (片段, 片段ID)
+
+    每个文件的页数、片段ID和每个片段所在页码写进 per_file；make_id(path, i) 负责生成片段ID。
+    切分是逐页进行的，所以分段解析和整份解析得到的片段和ID完全一样。
+    主进程在向量化当前批次时，进程池还在后台解析后面的页。
+    """
+    paths = list(paths)
+    for path in paths:
+        per_file[path] = {"num_pages": 0, "chunk_ids": [], "chunk_pages": []}
+    docs, ids = [], []
+    for path, pages in iter_parsed_pages(paths, max_workers):
+        info = per_file[path]
+        chunks = text_splitter.split_documents(pages)
+        first = len(info["chunk_ids"])
+        chunk_ids = [make_id(path, first + i) for i in range(len(chunks))]
+        info["num_pages"] += len(pages)
+        info["chunk_ids"].extend(chunk_ids)
+        info["chunk_pages"].extend(c.metadata.get("page") for c in chunks)
+        docs.extend(chunks)
+        ids.extend(chunk_ids)
+        while len(docs) >= batch_size:
+            yield docs[:batch_size], ids[:batch_size]
+            docs, ids = docs[batch_size:], ids[batch_size:]
+    if docs:
+        yield docs, ids
+
+
+def peak_memory_mb():
+    """本进程的内存峰值（MB）；Linux/macOS 用 resource，Windows 用 psutil，都没有时返回 None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024   # macOS 单位是字节
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return getattr(info, "peak_wset", info.rss) / 1024 / 1024
+    except ImportError:
+        return None
@@ -1 +1,105 @@
-#wait for sometime to rebuild ,not now.
\ No newline at end of file
+# RAG_demo/logger_utils.py
+# 问答日志：结构化 JSONL，由后台线程批量写盘，按大小/时间轮转，旧文件可压缩成 .gz
+import os
+import glob
+import gzip
+import json
+import queue
+import atexit
+import shutil
+import datetime
+import threading
+import time
+
+_STOP = object()
+
+
+class JsonlLogger:
+    """后台线程写日志，log() 只往队列里放一条记录，不会卡住问答
+
+    max_bytes       单个日志文件超过这个大小就轮转（0 表示不按大小轮转）
+    rotate_seconds  距上次轮转超过这么多秒就轮转（None 表示不按时间轮转，如 86400 每天一份）
+    backup_count    保留的旧日志文件个数
+    compress        轮转出来的旧文件压缩成 .gz（在后台线程里做）
+    """
+    def __init__(self, path: str, max_bytes: int = 10 * 1024 * 1024, rotate_seconds: float = None,
+                 backup_count: int = 10, compress: bool = True, flush_interval: float = 1.0,
+                 batch_size: int = 200, queue_size: int = 10000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.rotate_seconds = rotate_seconds
+        self.backup_count = backup_count
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.dropped = 0   # 队列满时丢弃的记录数
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._opened_at = time.time()
+        self._thread = threading.Thread(target=self._run, name="jsonl-logger", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def log(self, **record):
+        record.setdefault("time", datetime.datetime.now().isoformat(timespec="seconds"))
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        """写完队列里剩下的记录再退出（程序退出时自动调用）"""
+        if self._thread.is_alive():
+            self._queue.put(_STOP)
+            self._thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+                while True:
+                    if item is _STOP:
+                        stopping = True
+                        break
+                    batch.append(item)
+                    if len(batch) >= self.batch_size:
+                        break
+                    item = self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            if batch:
+                self._write(batch)
+            if self._should_rotate():
+                self._rotate()
+
+    def _write(self, batch):
+        data = "".join(json.dumps(r, ensure_ascii=False, default=str) + "\n" for r in batch)
+        try:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(data)
+        except OSError as e:  # 写日志失败不影响问答
+            print(f"[日志] 写入失败: {e}")
+
+    def _should_rotate(self) -> bool:
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return False
+        if self.max_bytes and os.path.getsize(self.path) >= self.max_bytes:
+            return True
+        return self.rotate_seconds is not None and time.time() - self._opened_at >= self.rotate_seconds
+
+    def _rotate(self):
+        """当前文件改名为 <path>.<时间戳>，按需压缩，超出 backup_count 的最旧文件删除"""
+        self._opened_at = time.time()
+        rotated = f"{self.path}.{datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')}"
+        try:
+            os.replace(self.path, rotated)
+            if self.compress:
+                with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(rotated)
+            backups = sorted(glob.glob(glob.escape(self.path) + ".*"))
+            for old in backups[:max(0, len(backups) - self.backup_count)]:
+                os.remove(old)
+        except OSError as e:
+            print(f"[日志] 轮转失败: {e}")
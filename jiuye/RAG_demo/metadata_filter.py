@@ -0,0 +1,76 @@
+# RAG_demo/metadata_filter.py
+# 按文件/页码限定检索范围：先用元数据索引选出候选行，再只在这些行里做向量检索
+import os
+import re
+import numpy as np
+
+# 问题开头写 @文件名 或 @文件名:页码范围，例如 “@manual.pdf:3-5 怎么更换滤芯”（页码从1开始）
+SCOPE_RE = re.compile(r"^\s*@(?P<source>[^\s:]+)(?::(?P<start>\d+)(?:-(?P<end>\d+))?)?\s+(?P<query>.+)$", re.S)
+
+
+def parse_scope(query: str):
+    """拆出问题里的范围前缀，返回 (问题, 范围)；没写范围时范围为 None
+
+    范围格式 {"source": 文件名或路径的一部分, "pages": (起始页, 结束页) 或 None}，页码从1开始、含两端。
+    """
+    match = SCOPE_RE.match(query)
+    if not match:
+        return query, None
+    pages = None
+    if match.group("start"):
+        start = int(match.group("start"))
+        end = int(match.group("end") or start)
+        pages = (min(start, end), max(start, end))
+    return match.group("query").strip(), {"source": match.group("source"), "pages": pages}
+
+
+def match_sources(name: str, paths):
+    """完整路径、文件名、不带扩展名的文件名都可以，不区分大小写；都对不上时按文件名包含匹配"""
+    name = os.path.normpath(name).lower()
+    names = {p: os.path.basename(p).lower() for p in paths}
+    exact = [p for p, base in names.items()
+             if name in (os.path.normpath(p).lower(), base, os.path.splitext(base)[0])]
+    return exact or [p for p, base in names.items() if name in base]
+
+
+def resolve_scope(query: str, manifest: dict):
+    """parse_scope，再确认 @ 后面的名字能对上索引里的文件；对不上（如“@Override 注解是什么”）就不是范围前缀，
+    整句原样作为普通问题。各入口（rag_multi / rag_server / rag_batch）都用这个，行为一致。"""
+    stripped, scope = parse_scope(query)
+    if scope is None or not match_sources(scope["source"], manifest["files"]):
+        return query, None
+    return stripped, scope
+
+
+class MetadataIndex:
+    """文件 -> FAISS 行号 / 页码 的倒排表，由清单里记录的片段ID和页码生成，不需要读片段正文
+
+    aliases 是去重时 重复片段ID -> 规范片段ID 的映射（见 dedup.py），重复片段算作它的规范片段所在的行。
+    """
+    def __init__(self, manifest: dict, index_to_docstore_id: dict, aliases: dict = None):
+        row_of = {cid: row for row, cid in index_to_docstore_id.items()}
+        if aliases:
+            row_of.update((cid, row_of[canonical]) for cid, canonical in aliases.items() if canonical in row_of)
+        self.rows = {}    # 文件路径 -> 行号数组
+        self.pages = {}   # 文件路径 -> 与行号对齐的页码数组（从0开始，与 PyPDFLoader 一致）
+        for path, info in manifest["files"].items():
+            pairs = [(row_of[cid], page) for cid, page in zip(info["chunk_ids"], info["chunk_pages"])
+                     if cid in row_of]
+            self.rows[path] = np.array([row for row, _ in pairs], dtype=np.int64)
+            self.pages[path] = np.array([-1 if page is None else page for _, page in pairs], dtype=np.int64)
+
+    def match_sources(self, name: str):
+        return match_sources(name, self.rows)
+
+    def select_rows(self, scope: dict) -> np.ndarray:
+        """范围内所有片段的行号（升序）"""
+        selected = []
+        for path in self.match_sources(scope["source"]):
+            rows = self.rows[path]
+            if scope.get("pages"):
+                start, end = scope["pages"]
+                pages = self.pages[path]
+                rows = rows[(pages >= start - 1) & (pages <= end - 1)]
+            selected.append(rows)
+        # 去重后不同文件的片段可能对应同一行
+        return np.unique(np.concatenate(selected)) if selected else np.empty(0, dtype=np.int64)
@@ -0,0 +1,119 @@
+# RAG_demo/rag_batch.py
+# 批量问答：从 JSONL 读问题，批量检索 + 并发调用 LLM，结果写回 JSONL
+# 用法：python rag_batch.py questions.jsonl -o answers.jsonl -c 8
+# 输入每行一个 JSON，至少包含 question 字段（可选 id，没有就用行号），question 同样支持 @文件名:页码 前缀
+import os
+import json
+import time
+import asyncio
+import argparse
+import numpy as np
+from openai import AsyncOpenAI
+from rag_multi import MAX_CANDIDATES, load_knowledge_base, build_prompt
+from generator import ask_llm_async
+from metadata_filter import resolve_scope
+
+DEFAULT_CONCURRENCY = 8    # 同时在途的 LLM 请求数，太大容易触发接口限流
+RETRIEVE_BATCH_SIZE = 64   # 每批检索的问题数（查询向量一次算完，faiss 一次搜完）
+
+
+def read_questions(path: str):
+    items = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            item = json.loads(line)
+            item.setdefault("id", line_no)
+            items.append(item)
+    return items
+
+
+def percentile(values, q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def retrieve_all(rag_index, items, batch_size: int):
+    """分批检索并组装 prompt，返回每个问题的 (prompt, 装入的片段, 压缩比)"""
+    prepared = []
+    for start in range(0, len(items), batch_size):
+        batch = items[start:start + batch_size]
+        queries, scopes = zip(*(resolve_scope(item["question"], rag_index.manifest) for item in batch))
+        for query, docs in zip(queries, rag_index.search_batch(list(queries), k=MAX_CANDIDATES, scopes=scopes)):
+            prompt, packed, _, ratio = build_prompt(query, docs, rag_index.embeddings)
+            prepared.append((prompt, packed, ratio))
+    return prepared
+
+
+async def answer_all(items, prepared, output_path: str, concurrency: int):
+    """并发调用 LLM，每完成一个就写一行结果；返回每个问题的统计信息"""
+    aclient = AsyncOpenAI(
+        api_key=os.getenv("DEEPSEEK_API_KEY"),
+        base_url="https://api.deepseek.com"
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def answer_one(item, prompt, packed, ratio):
+        async with semaphore:
+            record = {"id": item["id"], "question": item["question"],
+                      "chunk_ids": [doc.id for doc, _ in packed], "compression_ratio": ratio}
+            try:
+                answer, stats = await ask_llm_async(aclient, prompt)
+                record.update(answer=answer, **stats)
+            except Exception as e:  # 单个问题失败不影响整批
+                record.update(answer=None, error=f"{type(e).__name__}: {e}")
+            return record
+
+    results = []
+    with open(output_path, "w", encoding="utf-8") as out:
+        tasks = [answer_one(item, *entry) for item, entry in zip(items, prepared)]
+        for future in asyncio.as_completed(tasks):
+            record = await future
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            results.append(record)
+            print(f"[{len(results)}/{len(tasks)}] {record['id']} "
+                  + ("失败: " + record["error"] if "error" in record else f"{record['total_time']:.2f}s"))
+    await aclient.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG 批量问答")
+    parser.add_argument("input", help="问题文件（JSONL，每行包含 question 字段）")
+    parser.add_argument("-o", "--output", default="answers.jsonl", help="结果文件（JSONL）")
+    parser.add_argument("-c", "--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="LLM 并发请求数")
+    parser.add_argument("-b", "--batch-size", type=int, default=RETRIEVE_BATCH_SIZE, help="每批检索的问题数")
+    args = parser.parse_args()
+
+    items = read_questions(args.input)
+    if not items:
+        print("问题文件为空")
+        return
+    rag_index = load_knowledge_base()
+
+    start = time.perf_counter()
+    prepared = retrieve_all(rag_index, items, args.batch_size)
+    retrieve_time = time.perf_counter() - start
+    print(f"[检索] {len(items)} 个问题，用时 {retrieve_time:.2f}s（{len(items) / retrieve_time:.1f} 个/秒）")
+
+    results = asyncio.run(answer_all(items, prepared, args.output, args.concurrency))
+    total_time = time.perf_counter() - start
+
+    ok = [r for r in results if "error" not in r]
+    latencies = [r["total_time"] for r in ok]
+    print(f"[完成] 成功 {len(ok)}/{len(results)}，总耗时 {total_time:.2f}s，"
+          f"吞吐 {len(results) / total_time:.2f} 个/秒")
+    print(f"[延迟] p50={percentile(latencies, 50):.2f}s, p95={percentile(latencies, 95):.2f}s, "
+          f"最大={max(latencies, default=0.0):.2f}s")
+    input_tokens = sum(r["input_tokens"] for r in ok)
+    hit_tokens = sum(r["cache_hit_tokens"] for r in ok)
+    print(f"[统计] 总tokens={sum(r['total_tokens'] for r in ok)}, "
+          f"缓存命中率={hit_tokens / input_tokens if input_tokens else 0:.0%}, "
+          f"约花费={sum(r['cost'] for r in ok):.6f}元（缓存省了{sum(r['cache_savings'] for r in ok):.6f}元），"
+          f"结果已写入 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
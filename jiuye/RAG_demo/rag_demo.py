@@ -1,11 +1,12 @@
 import os
-import datetime
 from dotenv import load_dotenv
 from openai import OpenAI
-from langchain_community.document_loaders import PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import HuggingFaceEmbeddings
+from embedding_cache import CachedEmbeddings
+from retriever import INDEX_DIR, load_or_build_index
+from logger_utils import JsonlLogger
+from compressor import COMPRESS_TOKEN_BUDGET, compress_context
+from generator import build_messages, ask_llm
 
 # 读取 .env 文件
 load_dotenv()
@@ -19,66 +20,58 @@ if not os.getenv("DEEPSEEK_API_KEY"):
     raise ValueError("请在.env文件中设置DEEPSEEK_API_KEY")
 
 
-# 加载 PDF 文档
-loader = PyPDFLoader("data/sample.pdf")
-documents = loader.load()
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+STREAM = True     # 流式输出回答
+CACHE_FRIENDLY_PROMPT = True   # 固定系统提示词 + 片段按文档位置排序 + 问题放最后，提高 DeepSeek 前缀缓存命中率
+COMPRESS = False  # 抽取式压缩：只把和问题最相关的句子发给 LLM，省输入 token
 
-# 切分文档
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=100)
-docs = text_splitter.split_documents(documents)
 
-# 使用本地 HuggingFace Embedding 模型
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
+def main():
+    # 使用本地 HuggingFace Embedding 模型，外面套一层向量缓存（emb_cache/，两个脚本共用）
+    embeddings = CachedEmbeddings(HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL), EMBEDDING_MODEL,
+                                  symmetric=True)
 
-# 构建向量索引
-vectorstore = FAISS.from_documents(docs, embeddings)
-
-# 定义一个函数，用 DeepSeek 回答问题，并统计 token 消耗
-def ask_llm(prompt: str):
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[{"role": "user", "content": prompt}],
-        stream=False
+    # 加载或构建向量索引（sample.pdf 和参数都没变时直接读取磁盘缓存）
+    rag_index = load_or_build_index(
+        ["data/sample.pdf"], embeddings, EMBEDDING_MODEL,
+        chunk_size=800, chunk_overlap=100,
+        index_dir=os.path.join(INDEX_DIR, "demo"),
     )
 
-    # 默认值
-    input_tokens = output_tokens = total_tokens = 0
-    cost = 0.0
-
-    # 统计 token 消耗
-    usage = response.usage
-    if usage:
-        input_tokens = usage.prompt_tokens
-        output_tokens = usage.completion_tokens
-        total_tokens = usage.total_tokens
-        cost = input_tokens/1e6*2 + output_tokens/1e6*3  # 按 DeepSeek 价格估算
-        print(f"[统计] 输入tokens={input_tokens}, 输出tokens={output_tokens}, 总tokens={total_tokens}, 约花费={cost:.6f}元")
-
-    answer = response.choices[0].message.content
-    return answer, input_tokens, output_tokens, total_tokens, cost
-
-# 循环问答
-print("RAG Demo 已启动，输入 exit 退出")
-while True:
-    query = input("请输入问题: ")
-    if query.lower() in ["exit", "quit"]:
-        break
-
-    # 检索相关文档
-    docs = vectorstore.similarity_search(query, k=3)
-    context = "\n".join([d.page_content for d in docs])
-    prompt = f"以下是相关文档内容：\n{context}\n\n请根据这些内容回答问题：{query}"
-
-    # 调用 LLM
-    answer, input_tokens, output_tokens, total_tokens, cost = ask_llm(prompt)
-
-    # === 日志记录 ===
-    with open("logs.txt", "a", encoding="utf-8") as f:
-        f.write("==== 新的一次问答 ====\n")
-        f.write(f"时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        f.write(f"问题: {query}\n")
-        f.write(f"回答: {answer}\n")
-        f.write(f"输入tokens: {input_tokens}, 输出tokens: {output_tokens}, 总tokens: {total_tokens}, 费用估算: {cost:.6f}元\n\n")
-
-    # 控制台输出
-    print("回答:", answer)
+    # 问答日志（JSONL，超过10MB自动轮转并压缩）
+    qa_log = JsonlLogger("logs.jsonl")
+
+    # 循环问答
+    print("RAG Demo 已启动，输入 exit 退出")
+    while True:
+        query = input("请输入问题: ")
+        if query.lower() in ["exit", "quit"]:
+            break
+
+        # 检索相关文档
+        docs = rag_index.search(query, k=3)
+        packed = [(d, d.page_content) for d in docs]
+        ratio = None
+        if COMPRESS and packed:
+            packed, before, after = compress_context(query, packed, embeddings, COMPRESS_TOKEN_BUDGET)
+            ratio = after / before if before else 1.0
+            print(f"[检索] 压缩为原来的 {ratio:.0%}（{before} -> {after} tokens）")
+        if CACHE_FRIENDLY_PROMPT:
+            prompt = build_messages(query, packed)
+        else:
+            context = "\n".join([text for _, text in packed])
+            prompt = f"以下是相关文档内容：\n{context}\n\n请根据这些内容回答问题：{query}"
+
+        # 调用 LLM（流式输出，边生成边打印）
+        answer, stats = ask_llm(client, prompt, stream=STREAM)
+
+        # === 日志记录（后台线程写盘，只记片段ID不记原文）===
+        qa_log.log(query=query, chunk_ids=[d.id for d, _ in packed], compression_ratio=ratio, answer=answer, **stats)
+
+        # 控制台输出（流式模式下回答已经边生成边打印过了）
+        if not STREAM:
+            print("回答:", answer)
+
+
+if __name__ == "__main__":
+    main()
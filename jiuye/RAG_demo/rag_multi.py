@@ -1,11 +1,18 @@
 import os
-import datetime
+import glob
+import time
 from dotenv import load_dotenv
 from openai import OpenAI
-from langchain_community.document_loaders import DirectoryLoader, PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import FAISS
 from langchain_huggingface import HuggingFaceEmbeddings
+from embedding_cache import CachedEmbeddings
+from retriever import INDEX_DIR, load_or_build_index
+from shards import ShardedIndex
+from watcher import LiveIndex
+from answer_cache import AnswerCache
+from logger_utils import JsonlLogger
+from metadata_filter import resolve_scope
+from compressor import COMPRESS_TOKEN_BUDGET, compress_context
+from generator import CONTEXT_TOKEN_BUDGET, pack_context, build_messages, ask_llm, usage_stats
 
 # 读取 .env 文件
 load_dotenv()
@@ -19,83 +26,148 @@ if not os.getenv("DEEPSEEK_API_KEY"):
     raise ValueError("请在.env文件中设置DEEPSEEK_API_KEY")
 
 
-# 加载 data/ 文件夹下所有 PDF
-loader = DirectoryLoader("data", glob="*.pdf", loader_cls=PyPDFLoader)
-documents = loader.load()
-if not documents:
-    print("警告：未找到任何PDF文件")
-    exit(1)
-
-# 切分文档
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=800, chunk_overlap=100)
-docs = text_splitter.split_documents(documents)
-
-# 使用本地 HuggingFace Embedding 模型
-embeddings = HuggingFaceEmbeddings(model_name="sentence-transformers/all-MiniLM-L6-v2")
-
-# 构建向量索引
-vectorstore = FAISS.from_documents(docs, embeddings)
-
-# 定义一个函数，用 DeepSeek 回答问题，并统计 token 消耗
-def ask_llm(prompt: str):
-    response = client.chat.completions.create(
-        model="deepseek-chat",
-        messages=[{"role": "user", "content": prompt}],
-        stream=False
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+CHUNK_SIZE = 800
+CHUNK_OVERLAP = 100
+DEDUP_THRESHOLD = 0.85   # 近似重复片段（修订版、页眉页脚、重复条款）只保留一份，None 关闭；改这个值会全量重建
+# 索引类型：flat（精确，默认）/ ivf / hnsw / ivfpq，语料到百万片段级别时改用近似索引
+# storage 可选 fp32 / fp16 / int8，用一点精度换更小的内存占用
+# 检索参数 nprobe（ivf、ivfpq）/ ef_search（hnsw）随时可调，不需要重建索引，其他参数见 index_factory.py
+INDEX_CONFIG = {"type": "flat", "storage": "fp32"}
+STREAM = True         # 流式输出回答
+SHARDS = 1            # >1 时按文件把语料分成多片，每片一个子进程并行构建、并行检索（语料大到单进程吃不消时用）
+MAX_CANDIDATES = 12   # 检索候选片段数上限，最终装进 prompt 的数量由 token 预算决定
+CACHE_FRIENDLY_PROMPT = True   # 固定系统提示词 + 片段按文档位置排序 + 问题放最后，提高 DeepSeek 前缀缓存命中率
+COMPRESS = False      # 抽取式压缩：只把和问题最相关的句子发给 LLM（预算 COMPRESS_TOKEN_BUDGET），省输入 token
+HOT_RELOAD = True     # 监视 data/，PDF 增删改后在后台更新索引，不用重启
+ANSWER_CACHE = True   # 相同或换了说法的问题直接返回缓存的回答（阈值等见 answer_cache.py）
+
+
+def make_embeddings():
+    # 使用本地 HuggingFace Embedding 模型，外面套一层向量缓存（emb_cache/，两个脚本共用）
+    return CachedEmbeddings(HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL), EMBEDDING_MODEL, symmetric=True)
+
+
+def load_knowledge_base(embeddings=None):
+    """加载 data/ 下所有PDF对应的索引（批量问答等其他入口也复用这里）
+
+    传入 embeddings 时复用这个已加载的模型（热更新时用），否则新建一个。
+    """
+    # data/ 文件夹下所有 PDF
+    pdf_paths = sorted(glob.glob(os.path.join("data", "*.pdf")))
+    if not pdf_paths:
+        print("警告：未找到任何PDF文件")
+        exit(1)
+
+    if SHARDS > 1:
+        # 分片子进程各自创建 Embedding 模型，所以传的是函数而不是模型对象
+        return ShardedIndex(pdf_paths, make_embeddings, EMBEDDING_MODEL, SHARDS,
+                            chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+                            index_dir=os.path.join(INDEX_DIR, "multi"), index_config=INDEX_CONFIG,
+                            embeddings=embeddings, dedup_threshold=DEDUP_THRESHOLD)
+    embeddings = embeddings or make_embeddings()
+
+    # 加载或构建向量索引（语料和参数都没变时直接读取磁盘缓存，不再解析PDF和向量化）
+    return load_or_build_index(
+        pdf_paths, embeddings, EMBEDDING_MODEL,
+        chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP,
+        index_dir=os.path.join(INDEX_DIR, "multi"), index_config=INDEX_CONFIG,
+        dedup_threshold=DEDUP_THRESHOLD,
     )
 
-    # 默认值
-    input_tokens = output_tokens = total_tokens = 0
-    cost = 0.0
-
-    # 统计 token 消耗
-    usage = response.usage
-    if usage:
-        input_tokens = usage.prompt_tokens
-        output_tokens = usage.completion_tokens
-        total_tokens = usage.total_tokens
-        cost = input_tokens/1e6*2 + output_tokens/1e6*3  # 按 DeepSeek 价格估算
-        print(f"[统计] 输入tokens={input_tokens}, 输出tokens={output_tokens}, 总tokens={total_tokens}, 约花费={cost:.6f}元")
-
-    answer = response.choices[0].message.content
-    return answer, input_tokens, output_tokens, total_tokens, cost
-
-# 循环问答
-print("RAG Multi-Doc Demo 已启动，输入 exit 退出")
-while True:
-    query = input("请输入问题: ")
-    if query.lower() in ["exit", "quit"]:
-        break
-
-    # 检索相关文档
-    max_k = 12  # 可以根据需求调整
-    question_length = len(query)
-    if question_length < 20:
-        k = 3
-    elif question_length < 50:
-        k = 5
-    else:
-        k = 8
-    k = min(k, max_k)  # 上限保护（以后可能用到 因为到时候可能按照输入大小分配要多少片段
-    docs = vectorstore.similarity_search(query, k=k)
-
-    context = "\n".join([d.page_content for d in docs])
-    prompt = f"以下是相关文档内容：\n{context}\n\n请根据这些内容回答问题：{query}"
-
-    # 调用 LLM
-    answer, input_tokens, output_tokens, total_tokens, cost = ask_llm(prompt)
-
-    # === 日志记录 ===
-    with open("logs_multi.txt", "a", encoding="utf-8") as f:
-        f.write("==== 新的一次问答 ====\n")
-        f.write(f"时间: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}\n")
-        f.write(f"问题: {query}\n")
-        f.write(f"检索片段:\n{context}\n")
-        f.write(f"回答: {answer}\n")
-        f.write(f"输入tokens: {input_tokens}, 输出tokens: {output_tokens}, 总tokens: {total_tokens}, 费用估算: {cost:.6f}元\n\n")
-
-    # 控制台输出
-    print("回答:", answer)
-    print("可输入 exit 或 quit 退出（不会作为问题发送给模型），或按 Ctrl+C 强制结束")
-    print(f"共加载文档页数: {len(documents)}")
 
+def live_knowledge_base():
+    """HOT_RELOAD 打开时返回会自动更新的 LiveIndex，否则就是普通索引（常驻的入口用这个）"""
+    if not HOT_RELOAD:
+        return load_knowledge_base()
+    # 更新时复用当前索引的 Embedding 模型，只有增删改的文件需要重新解析和向量化
+    return LiveIndex(lambda old: load_knowledge_base(old.embeddings if old is not None else None)).start()
+
+
+def build_prompt(query: str, docs, embeddings=None):
+    """按排名装入片段直到用完 token 预算（替代原来按问题长度选 k=3/5/8 的做法），顺带去掉重叠内容
+
+    COMPRESS 打开且传了 embeddings 时，再做一次句子级的抽取式压缩。
+    CACHE_FRIENDLY_PROMPT 打开时 prompt 是 build_messages 生成的消息列表，否则是原来的单条字符串。
+    返回 (prompt, [(片段, 实际使用的文本)], 检索内容的token数, 压缩比)，没压缩时压缩比为 None。
+    """
+    packed, context_tokens = pack_context(docs, CONTEXT_TOKEN_BUDGET)
+    ratio = None
+    if COMPRESS and embeddings is not None and packed:
+        packed, before, context_tokens = compress_context(query, packed, embeddings, COMPRESS_TOKEN_BUDGET)
+        ratio = context_tokens / before if before else 1.0
+    if CACHE_FRIENDLY_PROMPT:
+        return build_messages(query, packed), packed, context_tokens, ratio
+    context = "\n".join([text for _, text in packed])
+    prompt = f"以下是相关文档内容：\n{context}\n\n请根据这些内容回答问题：{query}"
+    return prompt, packed, context_tokens, ratio
+
+
+def scope_not_found(scope: dict) -> str:
+    """范围前缀对上了文件但范围内没有片段（页码超出等）时的提示，rag_server 也用这句，不调用 LLM"""
+    pages = f"第 {scope['pages'][0]}-{scope['pages'][1]} 页" if scope.get("pages") else ""
+    return f"{scope['source']} {pages}没有找到可检索的内容"
+
+
+def main():
+    rag_index = live_knowledge_base()
+
+    # 问答日志（JSONL，超过10MB自动轮转并压缩）
+    qa_log = JsonlLogger("logs_multi.jsonl")
+    answer_cache = AnswerCache() if ANSWER_CACHE else None
+
+    # 循环问答
+    print("RAG Multi-Doc Demo 已启动，输入 exit 退出")
+    print("问题前加 @文件名 或 @文件名:起始页-结束页 可以只在指定文档/页码里检索，如 @manual.pdf:3-5 怎么更换滤芯")
+    while True:
+        query = input("请输入问题: ")
+        if query.lower() in ["exit", "quit"]:
+            break
+
+        # 检索相关文档：向量 + BM25 混合检索，编号、专有名词也能命中
+        query, scope = resolve_scope(query, rag_index.manifest)   # @ 后面对不上文件名时按普通问题处理
+        if answer_cache is not None:
+            # 查询向量在 Embedding 缓存里，下面检索时不会重复计算
+            start = time.perf_counter()
+            query_vector = rag_index.embeddings.embed_query(query)
+            cached = answer_cache.get(query_vector, scope, rag_index.manifest)
+            if cached is not None:
+                print(f"[答案缓存] 命中（相似度 {cached['similarity']:.3f}，原问题：{cached['query']}）")
+                print("回答:", cached["answer"])
+                qa_log.log(query=query, scope=scope, chunk_ids=cached["chunk_ids"], answer=cached["answer"],
+                           answer_cache="hit", similarity=cached["similarity"], cached_query=cached["query"],
+                           answer_cache_hit_rate=answer_cache.hit_rate,
+                           **usage_stats(None, None, time.perf_counter() - start))   # 没调用 LLM，token 和费用都是0
+                continue
+        docs = rag_index.search(query, k=MAX_CANDIDATES, scope=scope)
+        if scope and not docs:
+            print(f"[检索] {scope_not_found(scope)}")
+            continue
+
+        prompt, packed, context_tokens, ratio = build_prompt(query, docs, rag_index.embeddings)
+        print(f"[检索] 候选 {len(docs)} 个片段，装入 {len(packed)} 个，约 {context_tokens} tokens"
+              + (f"（压缩为原来的 {ratio:.0%}）" if ratio is not None else ""))
+
+        # 调用 LLM（流式输出，边生成边打印）
+        answer, stats = ask_llm(client, prompt, stream=STREAM)
+
+        chunk_ids = [doc.id for doc, _ in packed]
+        cache_fields = {}
+        if answer_cache is not None:
+            answer_cache.put(query, query_vector, scope, rag_index.manifest, answer, chunk_ids)
+            cache_fields = {"answer_cache": "miss", "answer_cache_hit_rate": answer_cache.hit_rate}
+
+        # === 日志记录（后台线程写盘，只记片段ID不记原文）===
+        qa_log.log(query=query, scope=scope, chunk_ids=chunk_ids, candidates=len(docs),
+                   context_tokens=context_tokens, compression_ratio=ratio, answer=answer, **cache_fields, **stats)
+
+        # 控制台输出（流式模式下回答已经边生成边打印过了）
+        if not STREAM:
+            print("回答:", answer)
+        print("可输入 exit 或 quit 退出（不会作为问题发送给模型），或按 Ctrl+C 强制结束")
+        print(f"共加载文档页数: {rag_index.manifest['num_pages']}")
+
+
+if __name__ == "__main__":
+    # 解析PDF用了多进程，Windows 下子进程会重新导入本文件，必须放在 main 保护里
+    main()
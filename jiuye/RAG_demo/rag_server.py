@@ -0,0 +1,107 @@
+# RAG_demo/rag_server.py
+# 常驻的 RAG 服务：启动时加载一次索引和 Embedding 模型，之后通过本地 TCP 端口接收请求
+# 协议：每行一个 JSON 请求，每行一个 JSON 响应，响应带回请求里的 id（同一连接可以连续发多个请求）
+#   {"id": 1, "op": "ask", "query": "..."}         -> {"id": 1, "ok": true, "answer": "...", "chunk_ids": [...], "stats": {...}, "cached": false}
+#   {"id": 2, "op": "retrieve", "query": "...", "k": 5} -> {"id": 2, "ok": true, "chunks": [{"id", "source", "page", "text", "dup_sources"}]}
+#   {"id": 3, "op": "ping"}                        -> {"id": 3, "ok": true, "num_chunks": ...}
+# query 支持 @文件名:页码范围 前缀（见 metadata_filter.resolve_scope）；出错时返回 {"id": ..., "ok": false, "error": "..."}
+import os
+import json
+import time
+import socketserver
+from rag_multi import client, MAX_CANDIDATES, ANSWER_CACHE, live_knowledge_base, build_prompt, scope_not_found
+from generator import ask_llm, usage_stats
+from answer_cache import AnswerCache
+from logger_utils import JsonlLogger
+from metadata_filter import resolve_scope
+
+HOST = "127.0.0.1"   # 只监听本机
+PORT = int(os.getenv("RAG_SERVER_PORT", "8765"))
+
+
+class RagRequestHandler(socketserver.StreamRequestHandler):
+    """一个连接一个线程，连接内的请求按顺序处理"""
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            request_id = None
+            try:
+                request = json.loads(line)
+                request_id = request.get("id")
+                response = self.server.dispatch(request)
+                response.update(id=request_id, ok=True)
+            except Exception as e:  # 单个请求出错不影响连接和服务
+                response = {"id": request_id, "ok": False, "error": f"{type(e).__name__}: {e}"}
+            self.wfile.write((json.dumps(response, ensure_ascii=False) + "\n").encode("utf-8"))
+            self.wfile.flush()
+
+
+class RagServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, rag_index):
+        super().__init__(address, RagRequestHandler)
+        self.rag_index = rag_index
+        self.qa_log = JsonlLogger("logs_server.jsonl")
+        self.answer_cache = AnswerCache() if ANSWER_CACHE else None
+
+    def dispatch(self, request: dict) -> dict:
+        op = request.get("op")
+        if op == "ping":
+            return {"num_chunks": self.rag_index.manifest["num_chunks"]}
+        query = request.get("query")
+        if not query:
+            raise ValueError("缺少 query")
+        query, scope = resolve_scope(query, self.rag_index.manifest)
+        if op == "retrieve":
+            docs = self.rag_index.search(query, k=int(request.get("k", MAX_CANDIDATES)), scope=scope)
+            return {"chunks": [{"id": d.id, "source": d.metadata.get("source"), "page": d.metadata.get("page"),
+                                "text": d.page_content, "dup_sources": d.metadata.get("dup_sources", [])}
+                               for d in docs]}
+        if op == "ask":
+            start = time.perf_counter()
+            if self.answer_cache is not None:
+                query_vector = self.rag_index.embeddings.embed_query(query)
+                cached = self.answer_cache.get(query_vector, scope, self.rag_index.manifest)
+                if cached is not None:
+                    stats = usage_stats(None, None, time.perf_counter() - start)
+                    self.qa_log.log(query=query, scope=scope, chunk_ids=cached["chunk_ids"], answer=cached["answer"],
+                                    answer_cache="hit", similarity=cached["similarity"],
+                                    cached_query=cached["query"],
+                                    answer_cache_hit_rate=self.answer_cache.hit_rate, **stats)
+                    return {"answer": cached["answer"], "chunk_ids": cached["chunk_ids"], "stats": stats,
+                            "cached": True}
+            docs = self.rag_index.search(query, k=MAX_CANDIDATES, scope=scope)
+            if scope and not docs:   # 和 rag_multi 一样不调用 LLM，不能让它在没有资料的情况下回答
+                raise ValueError(scope_not_found(scope))
+            prompt, packed, context_tokens, ratio = build_prompt(query, docs,
+                                                                 self.rag_index.embeddings)
+            retrieve_time = time.perf_counter() - start
+            answer, stats = ask_llm(client, prompt, stream=False)
+            chunk_ids = [doc.id for doc, _ in packed]
+            cache_fields = {}
+            if self.answer_cache is not None:
+                self.answer_cache.put(query, query_vector, scope, self.rag_index.manifest, answer, chunk_ids)
+                cache_fields = {"answer_cache": "miss", "answer_cache_hit_rate": self.answer_cache.hit_rate}
+            self.qa_log.log(query=query, scope=scope, chunk_ids=chunk_ids, candidates=len(docs),
+                            context_tokens=context_tokens, compression_ratio=ratio, answer=answer,
+                            retrieve_time=retrieve_time, **cache_fields, **stats)
+            return {"answer": answer, "chunk_ids": chunk_ids, "stats": stats, "cached": False}
+        raise ValueError(f"未知的 op: {op}")
+
+
+def main():
+    rag_index = live_knowledge_base()   # data/ 里的PDF变了会在后台更新，不用重启服务
+    with RagServer((HOST, PORT), rag_index) as server:
+        print(f"RAG 服务已启动：{HOST}:{PORT}（Ctrl+C 退出）")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    # 解析PDF用了多进程，Windows 下子进程会重新导入本文件，必须放在 main 保护里
+    main()
@@ -1 +1,588 @@
-#wait for sometime to rebuild ,not now.
\ No newline at end of file
+# RAG_demo/retriever.py
+# 向量索引的构建、持久化和检索，rag_demo.py / rag_multi.py 共用
+import os
+import json
+import pickle
+import hashlib
+import uuid
+import tempfile
+from contextlib import contextmanager
+import faiss
+import numpy as np
+from langchain_core.documents import Document
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from langchain_community.vectorstores import FAISS
+from ingest import iter_chunk_batches, peak_memory_mb
+from docstore import MmapDocstore
+from sparse_index import BM25Index, rrf_fuse
+from metadata_filter import MetadataIndex
+from dedup import ChunkDeduplicator
+from index_factory import resolve_config, build_params, needs_training, create_index, apply_search_params
+
+INDEX_DIR = "faiss_index"          # 索引缓存根目录，每个入口脚本一个子目录
+MANIFEST_VERSION = 9               # 清单格式变化时递增，旧缓存自动失效
+
+# 限定范围检索时，候选片段不超过这个数就直接取出向量精确计算（比带过滤器扫描整个索引快）
+EXACT_FILTER_LIMIT = 50000
+
+PROGRESS_EVERY = 10   # 构建索引时每处理这么多批打印一次进度和内存峰值
+
+ADD_ROWS = 65536      # 训练完之后从临时文件往索引里加向量，每次加这么多行
+
+# 优先用 FlatCodes 的零拷贝 mmap，老版本 faiss 没有这个标志就用普通 mmap
+MMAP_FLAGS = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+
+
+def file_sha256(path: str, block_size: int = 1 << 20) -> str:
+    """分块计算文件内容哈希，避免大PDF一次读进内存"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def scan_files(paths, previous=None) -> dict:
+    """收集每个文件的指纹；mtime和大小都没变时沿用上次的哈希，不重新读文件"""
+    previous = previous or {}
+    files = {}
+    for path in sorted(paths):
+        stat = os.stat(path)
+        old = previous.get(path)
+        if old and old["mtime"] == stat.st_mtime and old["size"] == stat.st_size:
+            sha = old["sha256"]
+        else:
+            sha = file_sha256(path)
+        files[path] = {"sha256": sha, "mtime": stat.st_mtime, "size": stat.st_size}
+    return files
+
+
+def corpus_fingerprint(files: dict, settings: dict) -> str:
+    """语料指纹 = 所有文件内容哈希 + 切分参数 + Embedding模型名"""
+    payload = json.dumps(
+        {
+            "version": MANIFEST_VERSION,
+            "files": {path: info["sha256"] for path, info in files.items()},
+            "settings": settings,
+        },
+        sort_keys=True,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def read_manifest(index_dir: str):
+    path = os.path.join(index_dir, "manifest.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None  # 清单损坏就当没有缓存，重新构建
+
+
+@contextmanager
+def index_lock(index_dir: str):
+    """索引目录的进程间互斥锁（目录下的 .lock 文件），同一时刻只有一个进程在读写这个目录的索引"""
+    os.makedirs(index_dir, exist_ok=True)
+    with open(os.path.join(index_dir, ".lock"), "a+b") as f:
+        if os.name == "nt":
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)   # 最多等10秒，拿不到抛 OSError，继续等
+                    break
+                except OSError:
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def _atomic_write(path: str, data: bytes):
+    """先写临时文件再替换，中途崩溃不会留下半个文件"""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class RagIndex:
+    """FAISS向量库 + BM25倒排索引 + 清单（文件哈希、切分参数、模型名），负责落盘、加载和检索
+
+    开启去重时 dedup 记录被合并掉的近似重复片段（见 dedup.py），否则为 None。
+    """
+    def __init__(self, vectorstore: FAISS, manifest: dict, bm25: BM25Index = None,
+                 dedup: ChunkDeduplicator = None):
+        self.vectorstore = vectorstore
+        self.manifest = manifest
+        self.bm25 = bm25
+        self.dedup = dedup
+        self._metadata = None
+
+    @property
+    def metadata(self) -> MetadataIndex:
+        """文件/页码 -> 行号的倒排表，第一次限定范围检索时才生成"""
+        if self._metadata is None:
+            aliases = self.dedup.canonical_of if self.dedup is not None else None
+            self._metadata = MetadataIndex(self.manifest, self.vectorstore.index_to_docstore_id, aliases)
+        return self._metadata
+
+    @property
+    def embeddings(self):
+        return self.vectorstore.embedding_function
+
+    def search(self, query: str, k: int = 3, hybrid: bool = True, scope: dict = None):
+        """有 BM25 索引时默认走混合检索，否则退回纯向量检索
+
+        scope 见 metadata_filter.parse_scope，只在指定文件/页码范围内检索（先过滤再做向量检索）。
+        """
+        if hybrid and self.bm25 is not None:
+            return [doc for doc, _ in self.hybrid_search(query, k, scope=scope)]
+        return [doc for doc, _ in self.dense_search(query, k, scope=scope)]
+
+    def get_chunk(self, chunk_id: str):
+        doc = self.vectorstore.docstore.search(chunk_id)
+        doc.id = chunk_id
+        if self.dedup is not None:
+            doc.metadata["dup_sources"] = self.dedup.sources_of(chunk_id)   # 被合并掉的重复片段的出处
+        return doc
+
+    def dense_search_ids(self, query: str, k: int, rows: np.ndarray = None):
+        """向量检索，返回 [(片段ID, L2距离)]；rows 不为 None 时只在这些行里检索"""
+        vector = self.embeddings.embed_query(query)
+        if rows is not None:
+            return self._search_rows(np.asarray(vector, dtype=np.float32), k, rows)
+        return self.dense_search_vectors([vector], k)[0]
+
+    def _search_rows(self, vector: np.ndarray, k: int, rows: np.ndarray):
+        """只在指定行里检索：候选少时取出向量直接算距离，耗时只和候选数有关；
+        候选多或者 IVF 类索引（不能按行取向量）时用 IDSelector 让 faiss 跳过其他行"""
+        if len(rows) == 0:
+            return []
+        index = self.vectorstore.index
+        mapping = self.vectorstore.index_to_docstore_id
+        ivf = faiss.try_extract_index_ivf(index)
+        if len(rows) <= EXACT_FILTER_LIMIT and ivf is None:
+            distances = ((index.reconstruct_batch(rows) - vector) ** 2).sum(axis=1)
+            top = np.argsort(distances)[:k] if len(rows) <= k else np.argpartition(distances, k)[:k]
+            top = top[np.argsort(distances[top])]
+            return [(mapping[int(rows[i])], float(distances[i])) for i in top]
+
+        selector = faiss.IDSelectorBatch(rows)
+        if ivf is not None:
+            params = faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+        elif isinstance(index, faiss.IndexHNSW):
+            params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+        else:
+            params = faiss.SearchParameters(sel=selector)
+        distances, found = index.search(vector.reshape(1, -1), k, params=params)
+        return [(mapping[row], float(dist)) for dist, row in zip(distances[0], found[0]) if row != -1]
+
+    def dense_search_vectors(self, vectors, k: int):
+        """一次检索多个查询向量（整个矩阵交给 faiss），返回每个查询的 [(片段ID, L2距离)]"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        distances, rows = self.vectorstore.index.search(vectors, k)
+        mapping = self.vectorstore.index_to_docstore_id
+        # 近似索引候选不足时会返回 -1
+        return [[(mapping[row], float(dist)) for dist, row in zip(dist_row, id_row) if row != -1]
+                for dist_row, id_row in zip(distances, rows)]
+
+    def search_batch(self, queries, k: int = 3, hybrid: bool = True, scopes=None):
+        """批量检索：查询向量一次算完、faiss 一次搜完，BM25 和 RRF 逐条做；返回每个查询的片段列表
+
+        scopes 与 queries 一一对应（None 表示不限范围），限定范围的查询单独在候选行里检索。
+        """
+        embeddings = self.embeddings
+        if hasattr(embeddings, "embed_queries"):
+            vectors = embeddings.embed_queries(queries)
+        else:
+            vectors = [embeddings.embed_query(q) for q in queries]
+        use_hybrid = hybrid and self.bm25 is not None
+        fetch_k = max(4 * k, 20) if use_hybrid else k
+        scopes = scopes or [None] * len(queries)
+        results = []
+        for query, vector, scope, dense in zip(queries, vectors, scopes, self.dense_search_vectors(vectors, fetch_k)):
+            dense, sparse = self.candidates(query, vector, fetch_k, scope, use_hybrid, dense)
+            ids = [cid for cid, _ in dense]
+            if use_hybrid:
+                ids = [cid for cid, _ in rrf_fuse([ids, [cid for cid, _ in sparse]])]
+            results.append([self.get_chunk(cid) for cid in ids[:k]])
+        return results
+
+    def candidates(self, query: str, vector, fetch_k: int, scope: dict = None, sparse: bool = True, dense=None):
+        """一个查询的两路候选 ([(片段ID, L2距离)], [(片段ID, BM25分)])，融合前的原始结果（分片检索时各分片返回这个）
+
+        dense 是批量检索时已经算好的不限范围结果，传了就不再检索一次。
+        """
+        allowed = None
+        if scope:
+            rows = self.metadata.select_rows(scope)
+            mapping = self.vectorstore.index_to_docstore_id
+            allowed = {mapping[int(row)] for row in rows}
+            dense = self._search_rows(np.asarray(vector, dtype=np.float32), fetch_k, rows)
+        elif dense is None:
+            dense = self.dense_search_vectors([vector], fetch_k)[0]
+        hits = self.bm25.search(query, fetch_k, allowed) if sparse and self.bm25 is not None else []
+        return dense, hits
+
+    def dense_search(self, query: str, k: int, scope: dict = None):
+        rows = self.metadata.select_rows(scope) if scope else None
+        return [(self.get_chunk(cid), dist) for cid, dist in self.dense_search_ids(query, k, rows)]
+
+    def hybrid_search(self, query: str, k: int, fetch_k: int = None, scope: dict = None):
+        """向量检索和 BM25 各取 fetch_k 个候选，用倒数排名融合（RRF）选出前 k 个，返回 [(片段, 融合分)]"""
+        fetch_k = fetch_k or max(4 * k, 20)
+        dense, sparse = self.candidates(query, self.embeddings.embed_query(query), fetch_k, scope)
+        fused = rrf_fuse([[cid for cid, _ in dense], [cid for cid, _ in sparse]])
+        return [(self.get_chunk(cid), score) for cid, score in fused[:k]]
+
+    def save(self, index_dir: str):
+        """写入 index.faiss / index.pkl / manifest.json，清单最后写，作为“缓存完整”的标志"""
+        os.makedirs(index_dir, exist_ok=True)
+        manifest_path = os.path.join(index_dir, "manifest.json")
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+
+        index_path = os.path.join(index_dir, "index.faiss")
+        faiss.write_index(self.vectorstore.index, index_path + ".tmp")
+        os.replace(index_path + ".tmp", index_path)
+
+        # 与 FAISS.save_local 的格式一致；mmap docstore 只序列化数据文件名和偏移表
+        docstore = self.vectorstore.docstore
+        store = (docstore, self.vectorstore.index_to_docstore_id)
+        _atomic_write(os.path.join(index_dir, "index.pkl"), pickle.dumps(store))
+        if self.bm25 is not None:
+            _atomic_write(os.path.join(index_dir, "bm25.pkl"), pickle.dumps(self.bm25))
+        if self.dedup is not None:
+            self.dedup.save_lsh(index_dir)
+            _atomic_write(os.path.join(index_dir, "dedup.pkl"), pickle.dumps(self.dedup))
+        _atomic_write(manifest_path, json.dumps(self.manifest, ensure_ascii=False, indent=2).encode("utf-8"))
+
+        # 全量重建后旧的正文数据文件就没用了（Windows 下仍被映射的文件删不掉，下次再删）
+        if isinstance(docstore, MmapDocstore):
+            docstore.attach(index_dir)   # 先映射上自己的数据文件，之后别的进程重建时删掉它也不影响读取
+            current = os.path.basename(docstore.path)
+            for name in os.listdir(index_dir):
+                if name.startswith("chunks_") and name.endswith(".dat") and name != current:
+                    try:
+                        os.remove(os.path.join(index_dir, name))
+                    except OSError:
+                        pass
+
+    @classmethod
+    def load(cls, index_dir: str, embeddings, manifest: dict, mmap: bool = True, index_config=None):
+        """加载已落盘的索引；mmap模式下向量不读入进程内存，多个进程可共享页缓存
+
+        index_config 里的 nprobe / ef_search 在这里生效，调整它们不需要重建索引。
+        """
+        index_path = os.path.join(index_dir, "index.faiss")
+        index = None
+        if mmap:
+            try:
+                index = faiss.read_index(index_path, MMAP_FLAGS)
+            except RuntimeError:
+                index = None  # 该索引类型不支持mmap，退回普通加载
+        if index is None:
+            index = faiss.read_index(index_path)
+        config = resolve_config(dict(manifest.get("index", {}), **(index_config or {})))
+        apply_search_params(index, config)
+        manifest["index"] = dict(manifest.get("index", {}), **config)
+
+        # index.pkl 是本程序自己写出的文件，可以信任
+        with open(os.path.join(index_dir, "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        if isinstance(docstore, MmapDocstore):
+            docstore.attach(index_dir)
+        vectorstore = FAISS(embeddings, index, docstore, index_to_docstore_id)
+
+        bm25 = None
+        bm25_path = os.path.join(index_dir, "bm25.pkl")
+        if os.path.exists(bm25_path):
+            with open(bm25_path, "rb") as f:
+                bm25 = pickle.load(f)
+        dedup = None
+        dedup_path = os.path.join(index_dir, "dedup.pkl")
+        if manifest.get("settings", {}).get("dedup") and os.path.exists(dedup_path):
+            with open(dedup_path, "rb") as f:
+                dedup = pickle.load(f)   # 不含签名，增量更新用到时才加载 dedup_lsh.npz
+            dedup.attach(index_dir)
+        return cls(vectorstore, manifest, bm25, dedup)
+
+
+def chunk_id(path: str, sha256: str, i: int) -> str:
+    """片段ID = 文件路径 + 内容哈希前缀 + 序号；文件内容不变时ID稳定，可以按ID精确删除"""
+    return f"{path}#{sha256[:12]}#{i}"
+
+
+def _add_vectors(vectorstore: FAISS, docs, ids, vectors):
+    texts = [d.page_content for d in docs]
+    vectorstore.add_embeddings(list(zip(texts, vectors)), metadatas=[d.metadata for d in docs], ids=ids)
+
+
+def _new_docstore(index_config: dict, docstore_path: str):
+    if index_config["docstore"] == "memory":
+        return InMemoryDocstore()
+    os.makedirs(os.path.dirname(docstore_path) or ".", exist_ok=True)
+    open(docstore_path, "xb").close()   # 全量构建总是新建一个空文件，绝不截断已有的（可能正被别的索引映射着）
+    return MmapDocstore(docstore_path)
+
+
+def _new_vectorstore(embeddings, docs, ids, vectors, index_config: dict, docstore_path: str):
+    """用第一批向量创建不需要训练的索引，再把它们加进去"""
+    index, spec = create_index(index_config, np.array(vectors, dtype=np.float32))
+    vectorstore = FAISS(embeddings, index, _new_docstore(index_config, docstore_path), {})
+    _add_vectors(vectorstore, docs, ids, vectors)
+    print(f"[索引] 索引类型 {spec}")
+    return vectorstore, spec
+
+
+class _SampledTraining:
+    """全量构建需要训练的索引（ivf / ivfpq / int8）时用：正文直接写进 docstore，向量顺序写到索引目录下的临时文件，
+    同时对行号做蓄水池抽样。整个语料处理完才用抽到的 train_size 个向量训练，再从临时文件分批加进索引，
+    所以训练样本均匀覆盖所有文件，而不只是文件顺序排在前面的几个 PDF；内存只和 train_size、批大小有关"""
+
+    def __init__(self, index_config: dict, docstore_path: str):
+        self.config = index_config
+        self.docstore_path = docstore_path
+        self.docstore = None   # 第一批片段到了才建，没有片段时不留下空文件
+        self.file = None
+        self.ids = []
+        self.sample = np.empty(0, dtype=np.int64)   # 抽中的行号
+        self.rng = np.random.default_rng(0)         # 固定种子，同样的语料得到同样的索引
+        self.dim = None
+
+    def add(self, docs, ids, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self.docstore is None:
+            self.docstore = _new_docstore(self.config, self.docstore_path)
+            self.file = tempfile.TemporaryFile(dir=os.path.dirname(self.docstore_path) or ".")
+            self.dim = vectors.shape[1]
+        size = self.config["train_size"]
+        rows = np.arange(len(self.ids), len(self.ids) + len(ids))
+        fill = max(0, min(len(rows), size - len(self.sample)))
+        self.sample = np.concatenate([self.sample, rows[:fill]])
+        rest = rows[fill:]
+        if len(rest):
+            # 第 i 行以 size/(i+1) 的概率替换样本里随机的一行
+            slots = self.rng.integers(0, rest + 1)
+            keep = slots < size
+            self.sample[slots[keep]] = rest[keep]
+        self.file.write(vectors.tobytes())
+        self.docstore.add({cid: Document(id=cid, page_content=d.page_content, metadata=d.metadata)
+                           for cid, d in zip(ids, docs)})
+        self.ids.extend(ids)
+
+    def finish(self, embeddings):
+        """用样本训练并把所有向量加进索引，返回 (vectorstore, 索引描述串)；一个片段都没有时返回 (None, None)"""
+        if not self.ids:
+            return None, None
+        self.file.flush()
+        vectors = np.memmap(self.file, dtype=np.float32, mode="r", shape=(len(self.ids), self.dim))
+        index, spec = create_index(self.config, np.array(vectors[np.sort(self.sample)]))
+        print(f"[索引] 用 {len(self.sample)} 个抽样向量训练完成，开始加入全部 {len(self.ids)} 个向量")
+        for start in range(0, len(self.ids), ADD_ROWS):
+            index.add(np.ascontiguousarray(vectors[start:start + ADD_ROWS]))
+        del vectors
+        self.file.close()
+        print(f"[索引] 索引类型 {spec}")
+        return FAISS(embeddings, index, self.docstore, dict(enumerate(self.ids))), spec
+
+
+def add_chunk_batches(vectorstore, paths, files: dict, embeddings, text_splitter,
+                      per_file: dict, index_config: dict, bm25: BM25Index,
+                      max_workers=None, docstore_path=None, dedup: ChunkDeduplicator = None):
+    """并行解析 paths 并按批向量化加入 vectorstore，同时写入 BM25 倒排索引，返回 (vectorstore, 索引描述串)
+
+    vectorstore 为 None 时新建（正文写到 docstore_path）：不需要训练的类型用第一批就建；
+    ivf/ivfpq/int8 等整个语料处理完，用从全部片段里抽样的 train_size 个向量训练（见 _SampledTraining）。
+    传了 dedup 时，近似重复的片段在向量化之前就去掉，只记下出处。
+    每处理 PROGRESS_EVERY 批打印一次进度和内存峰值，内存峰值应该只和批大小有关，不随语料增长。
+    """
+    make_id = lambda path, i: chunk_id(path, files[path]["sha256"], i)
+    spec = None
+    staged = _SampledTraining(index_config, docstore_path) \
+        if vectorstore is None and needs_training(index_config) else None
+    num_chunks = num_kept = 0
+    for n, (docs, ids) in enumerate(iter_chunk_batches(paths, text_splitter, make_id, per_file,
+                                                       max_workers=max_workers), 1):
+        num_chunks += len(docs)
+        if n % PROGRESS_EVERY == 0:
+            print(f"[索引] 已处理 {num_chunks} 个片段{_peak_memory_note()}")
+        if dedup is not None:
+            docs, ids = dedup.filter(docs, ids)
+            if not docs:
+                continue
+        num_kept += len(docs)
+        texts = [d.page_content for d in docs]
+        bm25.add(ids, texts)
+        vectors = embeddings.embed_documents(texts)
+        if staged is not None:
+            staged.add(docs, ids, vectors)
+        elif vectorstore is not None:
+            _add_vectors(vectorstore, docs, ids, vectors)
+        else:
+            vectorstore, spec = _new_vectorstore(embeddings, docs, ids, vectors, index_config, docstore_path)
+    if staged is not None:
+        vectorstore, spec = staged.finish(embeddings)
+    if num_chunks:
+        merged = f"（{num_chunks - num_kept} 个近似重复片段已合并）" if num_chunks > num_kept else ""
+        print(f"[索引] 新增 {num_kept} 个片段{merged}{_peak_memory_note()}")
+    return vectorstore, spec
+
+
+def _peak_memory_note() -> str:
+    peak = peak_memory_mb()
+    return f"，内存峰值 {peak:.0f} MB" if peak is not None else ""
+
+
+def diff_files(old_files: dict, new_files: dict):
+    """对比两次扫描结果，返回 (新增, 内容变化, 已删除) 的文件列表"""
+    added = [p for p in new_files if p not in old_files]
+    changed = [p for p in new_files
+               if p in old_files and old_files[p]["sha256"] != new_files[p]["sha256"]]
+    removed = [p for p in old_files if p not in new_files]
+    return added, changed, removed
+
+
+def _finish_manifest(files: dict, per_file: dict, settings: dict, fingerprint: str, num_chunks: int,
+                     index_info: dict) -> dict:
+    for path, info in files.items():
+        info.update(per_file[path])
+    return {
+        "version": MANIFEST_VERSION,
+        "fingerprint": fingerprint,
+        "settings": settings,
+        "index": index_info,   # 索引类型、实际使用的 faiss 描述串和检索参数
+        "files": files,
+        "num_pages": sum(info["num_pages"] for info in files.values()),
+        "num_chunks": num_chunks,
+    }
+
+
+def build_index(files: dict, embeddings, text_splitter, settings: dict, fingerprint: str,
+                index_config: dict, index_dir: str, max_workers=None) -> RagIndex:
+    """全量构建：解析所有文件、切分、向量化"""
+    per_file = {}
+    # 文件名带随机后缀：指纹可能回到以前的值（加一个文件再删掉），而旧名字的文件可能还在被正在服务的索引读着
+    docstore_path = os.path.join(index_dir, f"chunks_{fingerprint[:12]}_{uuid.uuid4().hex[:8]}.dat")
+    bm25 = BM25Index()
+    dedup = ChunkDeduplicator(settings["dedup"]) if settings.get("dedup") else None
+    vectorstore, spec = add_chunk_batches(None, list(files), files, embeddings, text_splitter,
+                                          per_file, index_config, bm25, max_workers, docstore_path, dedup)
+    if vectorstore is None:
+        raise ValueError("未能从PDF中解析出任何文本")
+    num_chunks = len(vectorstore.index_to_docstore_id)
+    index_info = dict(index_config, factory=spec)
+    manifest = _finish_manifest(files, per_file, settings, fingerprint, num_chunks, index_info)
+    return RagIndex(vectorstore, manifest, bm25, dedup)
+
+
+def update_index(rag_index: RagIndex, files: dict, embeddings, text_splitter, fingerprint: str,
+                 max_workers=None) -> RagIndex:
+    """增量更新：只删除/重新向量化有变化的文件，耗时和改动量成正比而不是和语料总量成正比"""
+    old_files = rag_index.manifest["files"]
+    added, changed, removed = diff_files(old_files, files)
+    print(f"[索引] 增量更新：新增 {len(added)}，修改 {len(changed)}，删除 {len(removed)} 个文件")
+
+    stale_ids = [cid for path in changed + removed for cid in old_files[path].get("chunk_ids", [])]
+    dedup = rag_index.dedup
+    if dedup is not None:
+        # 被删掉的规范片段还有别的文件里的重复片段指着它：那些文件没留正文，只能重新导入，
+        # 重新导入的文件里的规范片段又可能被别的文件指着，所以一直扩展到没有新文件为止
+        while True:
+            reingest = [p for p in dedup.dependents(stale_ids) if p in files and p not in changed and p not in added]
+            if not reingest:
+                break
+            print(f"[索引] 去重依赖，重新导入 {len(reingest)} 个文件")
+            changed += reingest
+            stale_ids += [cid for path in reingest for cid in old_files[path].get("chunk_ids", [])]
+        indexed = [cid for cid in stale_ids if cid not in dedup.canonical_of]   # 重复片段本来就不在索引里
+        dedup.remove(stale_ids)
+        stale_ids = indexed
+    if stale_ids and faiss.try_extract_index_ivf(rag_index.vectorstore.index) is not None:
+        # IVF 删除向量后剩下的向量保留原来的ID，之后新增又从 ntotal 开始编号，会和留下的ID重复；
+        # 而 LangChain 删除后把行号重排成 0..n-1，只对 flat / SQ 这种删除后会压缩的索引成立
+        raise ValueError("IVF 类索引不支持删除向量后继续增量更新")
+    if stale_ids:
+        rag_index.vectorstore.delete(stale_ids)
+        rag_index.bm25.remove(stale_ids)
+
+    per_file = {}
+    add_chunk_batches(rag_index.vectorstore, added + changed, files, embeddings, text_splitter,
+                      per_file, rag_index.manifest["index"], rag_index.bm25, max_workers, dedup=dedup)
+
+    # 没变的文件沿用旧清单里的页数、片段ID和页码
+    for path in files:
+        if path not in per_file:
+            per_file[path] = {key: old_files[path][key] for key in ("num_pages", "chunk_ids", "chunk_pages")}
+    num_chunks = len(rag_index.vectorstore.index_to_docstore_id)
+    rag_index.manifest = _finish_manifest(files, per_file, rag_index.manifest["settings"], fingerprint,
+                                          num_chunks, rag_index.manifest["index"])
+    rag_index._metadata = None   # 删除向量后行号会重排，元数据倒排表要重新生成
+    return rag_index
+
+
+def load_or_build_index(pdf_paths, embeddings, embedding_model: str,
+                        chunk_size: int = 800, chunk_overlap: int = 100,
+                        index_dir: str = INDEX_DIR, index_config=None, max_workers=None,
+                        dedup_threshold: float = None) -> RagIndex:
+    """指纹一致就直接加载缓存的索引；只有文件变了就增量更新；参数变了才全量重建
+
+    index_config 见 index_factory.DEFAULT_INDEX_CONFIG，可以只写要改的项，如 {"type": "hnsw"}。
+    dedup_threshold 不为 None 时开启近似重复片段去重（见 dedup.py），改这个值会全量重建。
+    """
+    index_config = resolve_config(index_config)
+    settings = {
+        "chunk_size": chunk_size,
+        "chunk_overlap": chunk_overlap,
+        "embedding_model": embedding_model,
+        "index": build_params(index_config),
+        "dedup": dedup_threshold,
+    }
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+    # 多个进程用同一个索引目录时（rag_multi 和 rag_server 同时热更新），只有拿到锁的进程构建/更新并落盘；
+    # 其他进程等它写完再读清单，指纹已经一致，直接从磁盘加载
+    with index_lock(index_dir):
+        manifest = read_manifest(index_dir)
+        files = scan_files(pdf_paths, manifest.get("files") if manifest else None)
+        fingerprint = corpus_fingerprint(files, settings)
+
+        if manifest and manifest.get("fingerprint") == fingerprint:
+            try:
+                rag_index = RagIndex.load(index_dir, embeddings, manifest, index_config=index_config)
+                print(f"[索引] 命中缓存 {index_dir}（{manifest['num_chunks']} 个片段，{manifest['index']['factory']}）")
+                return rag_index
+            except (OSError, RuntimeError, pickle.UnpicklingError, EOFError) as e:
+                print(f"[索引] 缓存加载失败，重新构建: {type(e).__name__}: {e}")
+                manifest = None
+
+        rag_index = None
+        if manifest and manifest.get("version") == MANIFEST_VERSION and manifest.get("settings") == settings:
+            try:
+                # 要在原索引上增删向量，不能用只读的mmap方式加载
+                # 有文件修改或删除时：HNSW 不支持按ID删除（抛 RuntimeError），IVF / IVF-PQ 删除后行号对不上
+                # （update_index 抛 ValueError），都退回全量重建；只新增文件时所有类型都能增量更新
+                rag_index = RagIndex.load(index_dir, embeddings, manifest, mmap=False, index_config=index_config)
+                rag_index = update_index(rag_index, files, embeddings, text_splitter, fingerprint, max_workers)
+            except (OSError, RuntimeError, ValueError, KeyError, pickle.UnpicklingError, EOFError) as e:
+                print(f"[索引] 增量更新失败，改为全量重建: {type(e).__name__}: {e}")
+                rag_index = None
+
+        if rag_index is None:
+            print(f"[索引] 全量构建索引（{len(files)} 个文件）")
+            rag_index = build_index(files, embeddings, text_splitter, settings, fingerprint, index_config,
+                                    index_dir, max_workers)
+        rag_index.save(index_dir)
+    return rag_index
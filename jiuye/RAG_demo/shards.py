@@ -0,0 +1,232 @@
+# RAG_demo/shards.py
+# 分片索引：按文件路径哈希把语料分成 N 片，每片一个独立的 RagIndex，由各自的子进程构建和检索
+# 协调进程只算一次查询向量，发给所有分片并行检索，再合并各分片的候选（向量按距离、BM25按分数）做 RRF
+import os
+import heapq
+import zlib
+import atexit
+import threading
+import multiprocessing as mp
+from collections import defaultdict
+from concurrent.futures import Future
+from retriever import INDEX_DIR, load_or_build_index
+from sparse_index import rrf_fuse
+
+
+def shard_of(path: str, num_shards: int) -> int:
+    """按路径分片（不按内容），文件修改后仍落在同一片，单个分片可以增量更新"""
+    return zlib.crc32(os.path.normpath(path).encode("utf-8")) % num_shards
+
+
+def source_of(chunk_id: str) -> str:
+    # 片段ID = 路径#哈希#序号，见 retriever.chunk_id
+    return chunk_id.rsplit("#", 2)[0]
+
+
+def _shard_worker(conn, paths, make_embeddings, embedding_model, chunk_size, chunk_overlap,
+                  index_dir, index_config, max_workers, dedup_threshold):
+    """分片子进程：加载或构建本分片的索引，然后循环处理协调进程发来的请求"""
+    try:
+        rag_index = load_or_build_index(paths, make_embeddings(), embedding_model, chunk_size=chunk_size,
+                                        chunk_overlap=chunk_overlap, index_dir=index_dir,
+                                        index_config=index_config, max_workers=max_workers,
+                                        dedup_threshold=dedup_threshold)
+    except Exception as e:
+        conn.send(("error", None, f"{type(e).__name__}: {e}"))
+        return
+    manifest = rag_index.manifest
+    # 文件哈希和切分参数供答案缓存判断片段是否变了
+    conn.send(("ready", None, {"num_pages": manifest["num_pages"], "num_chunks": manifest["num_chunks"],
+                               "index": manifest["index"], "settings": manifest["settings"],
+                               "files": {p: {"sha256": info["sha256"]} for p, info in manifest["files"].items()}}))
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            return
+        op, request_id = message[0], message[1]
+        try:
+            if op == "search":
+                _, _, query, vector, fetch_k, scope, hybrid = message
+                conn.send(("result", request_id, rag_index.candidates(query, vector, fetch_k, scope, hybrid)))
+            elif op == "search_batch":
+                # 不限范围的查询向量整个矩阵一次交给 faiss（和 RagIndex.search_batch 一样），限定范围的单独检索
+                _, _, queries, vectors, fetch_k, scopes, hybrid = message
+                dense = rag_index.dense_search_vectors(vectors, fetch_k)
+                conn.send(("result", request_id, [rag_index.candidates(q, v, fetch_k, s, hybrid, d)
+                                                  for q, v, s, d in zip(queries, vectors, scopes, dense)]))
+            elif op == "get":
+                conn.send(("result", request_id, [rag_index.get_chunk(cid) for cid in message[2]]))
+            elif op == "close":
+                return
+        except Exception as e:  # 单个请求出错不影响分片进程
+            conn.send(("error", request_id, f"{type(e).__name__}: {e}"))
+
+
+class ShardedIndex:
+    """对外接口和 RagIndex 一致（search / search_batch / manifest / embeddings），rag_multi 可以直接替换
+
+    make_embeddings 是无参的顶层函数，每个分片进程各自调用它创建 Embedding 模型（Windows 下要能被 pickle）。
+    各分片进程同时启动，构建也就是并行的；分片目录按分片数区分，改分片数会重建。
+    去重（dedup_threshold）在各分片内部进行，不同分片之间的重复片段不会合并。
+    多个线程可以同时查询：请求带编号发给各分片，每个分片一个收发线程按编号把回复交给等待的请求，
+    不再用一把锁包住整个收发过程；各分片进程按收到的顺序逐个处理。
+    """
+    def __init__(self, pdf_paths, make_embeddings, embedding_model: str, num_shards: int,
+                 chunk_size: int = 800, chunk_overlap: int = 100, index_dir: str = INDEX_DIR,
+                 index_config=None, embeddings=None, dedup_threshold=None):
+        groups = defaultdict(list)
+        for path in pdf_paths:
+            groups[shard_of(path, num_shards)].append(path)
+        workers_per_shard = max(1, (os.cpu_count() or 1) // max(1, len(groups)))
+
+        self.embeddings = embeddings or make_embeddings()   # 热更新时沿用已经加载好的模型
+        self.num_shards = num_shards
+        self._lock = threading.Lock()   # 保护请求编号和 _pending
+        self._next_id = 0
+        self._pending = {}  # (请求编号, 分片号) -> Future
+        self._shards = {}   # 分片号 -> (进程, 管道)
+        self._send_locks = {}   # 分片号 -> 锁，同一个管道同一时刻只能有一个线程在发
+        self._closed = False
+        ctx = mp.get_context("spawn")   # 子进程里还会开进程池解析PDF，统一用 spawn
+        for shard, paths in sorted(groups.items()):
+            parent, child = ctx.Pipe()
+            process = ctx.Process(
+                target=_shard_worker, name=f"rag-shard-{shard}",
+                args=(child, paths, make_embeddings, embedding_model, chunk_size, chunk_overlap,
+                      os.path.join(index_dir, f"shards{num_shards}", f"shard_{shard}"), index_config,
+                      workers_per_shard, dedup_threshold),
+            )
+            process.start()
+            child.close()
+            self._shards[shard] = (process, parent)
+            self._send_locks[shard] = threading.Lock()
+        atexit.register(self.close)
+
+        infos = {}
+        for shard, (_, conn) in self._shards.items():
+            status, _, info = conn.recv()
+            if status != "ready":
+                self.close()
+                raise RuntimeError(f"分片 {shard} 构建失败: {info}")
+            infos[shard] = info
+        for shard, (_, conn) in self._shards.items():
+            threading.Thread(target=self._receive, args=(shard, conn), name=f"rag-shard-{shard}-recv",
+                             daemon=True).start()
+        self.manifest = {
+            "num_pages": sum(info["num_pages"] for info in infos.values()),
+            "num_chunks": sum(info["num_chunks"] for info in infos.values()),
+            "index": dict(next(iter(infos.values()))["index"], shards=num_shards) if infos else {},
+            "settings": next(iter(infos.values()))["settings"] if infos else None,
+            "files": {path: info for shard_info in infos.values() for path, info in shard_info.pop("files").items()},
+            "shards": infos,
+        }
+        print(f"[索引] {len(infos)} 个分片已就绪，共 {self.manifest['num_chunks']} 个片段")
+
+    def _receive(self, shard, conn):
+        """收发线程：把分片的回复按请求编号交给等待的 Future；管道断了就让还在等这个分片的请求报错"""
+        while True:
+            try:
+                status, reply_id, payload = conn.recv()
+            except (EOFError, OSError):
+                break
+            with self._lock:
+                future = self._pending.pop((reply_id, shard), None)
+            if future is None:
+                continue
+            if status == "error":
+                future.set_exception(RuntimeError(f"分片 {shard}: {payload}"))
+            else:
+                future.set_result(payload)
+        with self._lock:
+            lost = [self._pending.pop(key) for key in list(self._pending) if key[1] == shard]
+        for future in lost:
+            future.set_exception(RuntimeError(f"分片 {shard}: 分片进程已断开"))
+
+    def _call(self, shards, messages):
+        """向多个分片同时发请求再等各自的回复（各分片并行处理），返回 {分片号: 结果}"""
+        with self._lock:
+            if self._closed:   # 不能返回空结果，否则 LLM 会在没有资料的情况下回答
+                raise RuntimeError("分片索引已关闭")
+            self._next_id += 1
+            request_id = self._next_id
+            futures = {shard: Future() for shard in shards}
+            self._pending.update(((request_id, shard), future) for shard, future in futures.items())
+        for shard in shards:
+            with self._send_locks[shard]:
+                self._shards[shard][1].send((messages[shard][0], request_id) + messages[shard][1:])
+        # 等所有分片都回复了再报错
+        results, errors = {}, []
+        for shard, future in futures.items():
+            try:
+                results[shard] = future.result()
+            except RuntimeError as e:
+                errors.append(str(e))
+        if errors:
+            raise RuntimeError("分片检索出错 " + "; ".join(errors))
+        return results
+
+    def get_chunks(self, chunk_ids):
+        """按片段ID找到所在分片取正文，保持传入的顺序"""
+        by_shard = defaultdict(list)
+        for cid in chunk_ids:
+            by_shard[shard_of(source_of(cid), self.num_shards)].append(cid)
+        results = self._call(list(by_shard), {shard: ("get", ids) for shard, ids in by_shard.items()})
+        docs = {doc.id: doc for shard_docs in results.values() for doc in shard_docs}
+        return [docs[cid] for cid in chunk_ids]
+
+    def search(self, query: str, k: int = 3, hybrid: bool = True, scope: dict = None):
+        return self.search_vector(query, self.embeddings.embed_query(query), k, hybrid, scope)
+
+    @staticmethod
+    def _merge(candidates, fetch_k: int, k: int, hybrid: bool):
+        """合并各分片的候选，返回前 k 个片段ID"""
+        # 所有分片用同一个 Embedding 模型，L2 距离可以直接比较；BM25 分数各分片统计量不同，只作近似合并
+        dense = heapq.nsmallest(fetch_k, (hit for d, _ in candidates for hit in d), key=lambda h: h[1])
+        ids = [cid for cid, _ in dense]
+        if hybrid:
+            sparse = heapq.nlargest(fetch_k, (hit for _, s in candidates for hit in s), key=lambda h: h[1])
+            if sparse:
+                ids = [cid for cid, _ in rrf_fuse([ids, [cid for cid, _ in sparse]])]
+        return ids[:k]
+
+    def search_vector(self, query: str, vector, k: int = 3, hybrid: bool = True, scope: dict = None):
+        fetch_k = max(4 * k, 20) if hybrid else k
+        message = ("search", query, vector, fetch_k, scope, hybrid)
+        results = self._call(list(self._shards), {shard: message for shard in self._shards})
+        return self.get_chunks(self._merge(results.values(), fetch_k, k, hybrid))
+
+    def search_batch(self, queries, k: int = 3, hybrid: bool = True, scopes=None):
+        """整批查询一条消息发给每个分片（分片里一次 faiss 检索），正文也一次取回"""
+        if hasattr(self.embeddings, "embed_queries"):
+            vectors = self.embeddings.embed_queries(queries)
+        else:
+            vectors = [self.embeddings.embed_query(q) for q in queries]
+        queries, vectors = list(queries), [list(v) for v in vectors]
+        scopes = list(scopes or [None] * len(queries))
+        fetch_k = max(4 * k, 20) if hybrid else k
+        message = ("search_batch", queries, vectors, fetch_k, scopes, hybrid)
+        results = self._call(list(self._shards), {shard: message for shard in self._shards})
+        ids = [self._merge([shard_results[i] for shard_results in results.values()], fetch_k, k, hybrid)
+               for i in range(len(queries))]
+        docs = self.get_chunks(list(dict.fromkeys(cid for query_ids in ids for cid in query_ids)))
+        by_id = {doc.id: doc for doc in docs}
+        return [[by_id[cid] for cid in query_ids] for query_ids in ids]
+
+    def close(self):
+        with self._lock:
+            shards, self._shards = self._shards, {}
+            self._closed = True
+        atexit.unregister(self.close)   # 热更新会反复新建分片索引，关掉的不能一直被 atexit 引用着
+        # 分片进程按顺序处理，close 之前已经发出的请求都会先回复（正在进行的查询照常做完）
+        for shard, (process, conn) in shards.items():
+            try:
+                with self._send_locks[shard]:
+                    conn.send(("close", None))
+            except (OSError, ValueError):
+                pass
+        for process, conn in shards.values():
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+            conn.close()
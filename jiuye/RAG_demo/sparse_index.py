@@ -0,0 +1,102 @@
+# RAG_demo/sparse_index.py
+# BM25 倒排索引：补向量检索的短板（型号、编号、中文专有名词这类需要字面匹配的词）
+import re
+import math
+import heapq
+from collections import Counter
+
+# 英文/数字词（允许 AB-1234、v1.2、foo_bar 这类带连接符的编号）或一段连续的中日韩文字
+TOKEN_RE = re.compile(
+    r"[A-Za-z0-9]+(?:[-_./][A-Za-z0-9]+)*"
+    r"|[\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff\u3040-\u30ff\uac00-\ud7af]+"
+)
+SPLIT_RE = re.compile(r"[-_./]")
+
+
+def tokenize(text: str) -> list:
+    """中日韩文字切成二元组（单字片段保留单字），英文数字小写；带连接符的编号同时保留整体和各部分"""
+    tokens = []
+    for match in TOKEN_RE.finditer(text):
+        word = match.group()
+        if word[0].isascii():
+            word = word.lower()
+            tokens.append(word)
+            parts = SPLIT_RE.split(word)
+            if len(parts) > 1:
+                tokens.extend(p for p in parts if p)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+
+class BM25Index:
+    """以片段ID为文档键的 BM25 倒排索引，支持按ID增删，跟着 FAISS 索引一起增量更新"""
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = {}     # 词 -> {片段ID: 词频}
+        self.doc_len = {}      # 片段ID -> 词数
+        self.doc_terms = {}    # 片段ID -> 出现过的词（删除时用）
+        self.total_len = 0
+
+    def __len__(self):
+        return len(self.doc_len)
+
+    def add(self, ids, texts):
+        for doc_id, text in zip(ids, texts):
+            counts = Counter(tokenize(text))
+            for term, tf in counts.items():
+                self.postings.setdefault(term, {})[doc_id] = tf
+            length = sum(counts.values())
+            self.doc_len[doc_id] = length
+            self.doc_terms[doc_id] = tuple(counts)
+            self.total_len += length
+
+    def remove(self, ids):
+        for doc_id in ids:
+            if doc_id not in self.doc_len:
+                continue
+            for term in self.doc_terms.pop(doc_id):
+                posting = self.postings.get(term)
+                if posting is not None:
+                    posting.pop(doc_id, None)
+                    if not posting:
+                        del self.postings[term]
+            self.total_len -= self.doc_len.pop(doc_id)
+
+    def search(self, query: str, k: int = 10, allowed=None):
+        """返回 [(片段ID, 分数)]，按分数从高到低；allowed 为片段ID集合时只在其中检索
+
+        限定范围时每个词遍历 倒排表 和 allowed 中较短的那个，范围小的查询耗时和范围大小有关，不随语料增长。
+        """
+        n = len(self.doc_len)
+        if n == 0:
+            return []
+        avg_len = self.total_len / n
+        scores = {}
+        for term in set(tokenize(query)):
+            posting = self.postings.get(term)
+            if not posting:
+                continue
+            idf = math.log(1 + (n - len(posting) + 0.5) / (len(posting) + 0.5))
+            if allowed is None:
+                hits = posting.items()
+            elif len(allowed) < len(posting):
+                hits = ((doc_id, posting[doc_id]) for doc_id in allowed if doc_id in posting)
+            else:
+                hits = ((doc_id, tf) for doc_id, tf in posting.items() if doc_id in allowed)
+            for doc_id, tf in hits:
+                norm = self.k1 * (1 - self.b + self.b * self.doc_len[doc_id] / avg_len)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+def rrf_fuse(rankings, k: int = 60):
+    """倒数排名融合：每路结果按名次给 1/(k+名次) 分，求和后排序；不需要各路分数可比"""
+    fused = {}
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking, start=1):
+            fused[doc_id] = fused.get(doc_id, 0.0) + 1.0 / (k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
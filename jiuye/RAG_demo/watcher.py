@@ -0,0 +1,149 @@
+# RAG_demo/watcher.py
+# 知识库热更新：监视 data/ 目录，PDF 增删改后在后台线程里增量更新索引，建好后再整体替换正在用的索引
+# 装了 watchdog 就用系统的文件变化通知（inotify / ReadDirectoryChangesW），否则定时轮询目录
+import os
+import glob
+import fnmatch
+import time
+import threading
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+
+DEBOUNCE_SECONDS = 3.0   # 最后一次变化之后安静这么久才开始更新（拷贝大文件、连续保存只触发一次）
+POLL_SECONDS = 2.0       # 没有 watchdog 时的轮询间隔
+
+
+def snapshot(directory: str, pattern: str = "*.pdf") -> dict:
+    """目录下文件的 (修改时间, 大小)，轮询时靠它发现变化；文件还在写入时大小会变"""
+    result = {}
+    for path in glob.glob(os.path.join(directory, pattern)):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue   # 扫描过程中被删掉了
+        result[path] = (stat.st_mtime_ns, stat.st_size)
+    return result
+
+
+class LiveIndex:
+    """正在使用的索引的包装，属性访问都转给当前索引，可以直接替换 RagIndex / ShardedIndex 传给检索代码
+
+    load(old_index) 返回一个完整可用的新索引（old_index 第一次为 None，用来复用已加载的 Embedding 模型）。
+    更新在后台线程里进行，新索引建好后才替换引用；一次检索调用拿到的始终是同一个索引，
+    不会看到建了一半的状态。更新失败时继续用旧索引。
+    替换下来的旧索引（分片索引要关子进程）到下一次替换时才关，替换前已经拿到旧索引的查询可以正常做完。
+    """
+    def __init__(self, load, directory: str = "data", pattern: str = "*.pdf",
+                 debounce: float = DEBOUNCE_SECONDS, poll_interval: float = POLL_SECONDS):
+        self._load = load
+        self.directory = directory
+        self.pattern = pattern
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.generation = 0   # 每次成功替换加 1
+        self._retired = None  # 上一次替换下来的旧索引，下一次替换或 stop() 时关掉
+        self._loaded = snapshot(directory, pattern)   # 当前索引对应的目录状态
+        self._current = load(None)
+        self._swap_lock = threading.Lock()
+        self._changed = threading.Event()
+        self._last_change = 0.0
+        self._stopped = threading.Event()
+        self._observer = None
+        self._thread = None
+
+    @property
+    def current(self):
+        return self._current
+
+    def __getattr__(self, name):
+        # 只有 LiveIndex 自己没有的属性才会走到这里
+        if name == "_current":
+            raise AttributeError(name)
+        return getattr(self._current, name)
+
+    def start(self):
+        """开始监视目录；装了 watchdog 用事件通知，否则轮询"""
+        if Observer is not None:
+            handler = FileSystemEventHandler()
+            handler.on_any_event = self._on_event
+            self._observer = Observer()
+            self._observer.schedule(handler, self.directory, recursive=False)
+            self._observer.start()
+        self._thread = threading.Thread(target=self._run, name="kb-watcher", daemon=True)
+        self._thread.start()
+        mode = "watchdog" if self._observer is not None else f"每 {self.poll_interval:g} 秒轮询"
+        print(f"[热更新] 正在监视 {self.directory}/{self.pattern}（{mode}）")
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._changed.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+        if self._thread is not None:
+            self._thread.join()
+        with self._swap_lock:
+            retired, self._retired = self._retired, None
+        _close(retired)
+
+    def _on_event(self, event):
+        paths = [event.src_path, getattr(event, "dest_path", "")]   # 重命名事件两个路径都要看
+        if not event.is_directory and any(fnmatch.fnmatch(os.path.basename(p), self.pattern) for p in paths if p):
+            self._mark_changed()
+
+    def _mark_changed(self):
+        self._last_change = time.monotonic()
+        self._changed.set()
+
+    def _run(self):
+        seen = snapshot(self.directory, self.pattern)
+        while not self._stopped.is_set():
+            self._changed.wait(self.poll_interval)
+            if self._stopped.is_set():
+                return
+            if self._observer is None:
+                current = snapshot(self.directory, self.pattern)
+                if current != seen:
+                    seen = current
+                    self._mark_changed()
+            if not self._changed.is_set():
+                continue
+            remaining = self.debounce - (time.monotonic() - self._last_change)
+            if remaining > 0:   # 还在变化，等安静下来
+                self._stopped.wait(min(remaining, self.poll_interval))
+                continue
+            self._changed.clear()
+            self.reload()   # 更新期间又有变化的话，下一轮会再更新一次
+
+    def reload(self):
+        """重新加载（没变的文件直接复用缓存，只处理增删改的文件），成功后原子替换，返回是否替换成功"""
+        with self._swap_lock:   # 手动调用和后台线程不会同时更新
+            state = snapshot(self.directory, self.pattern)
+            if state == self._loaded:
+                return False   # 文件改回原样、只是被打开过等情况，不用重新加载
+            old = self._current
+            start = time.perf_counter()
+            try:
+                new = self._load(old)
+            except (Exception, SystemExit) as e:   # load_knowledge_base 找不到PDF时会 exit
+                print(f"[热更新] 更新失败，继续使用旧索引: {type(e).__name__}: {e}")
+                return False
+            self._current = new
+            self._loaded = state
+            self.generation += 1
+            # 这时可能还有查询拿着 old 没做完，先留着，关掉再上一个
+            retired, self._retired = self._retired, (old if new is not old else None)
+        print(f"[热更新] 索引已替换（第 {self.generation} 版，{new.manifest['num_chunks']} 个片段，"
+              f"耗时 {time.perf_counter() - start:.1f}s）")
+        _close(retired)
+        return True
+
+
+def _close(index):
+    if index is not None and hasattr(index, "close"):
+        index.close()   # 分片索引要关掉旧的分片进程
@@ -3,9 +3,10 @@ import asyncio
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import uvicorn
-from agent_demo import agent, cost_tracker, log_handler, TRACK_COSTS
+from agent_demo import agent, cost_tracker, new_request_callbacks, search_cache, TRACK_COSTS
 from typing import Optional, List
 import json
 import os
@@ -27,9 +28,9 @@ app.add_middleware(
 # 内存中存储对话历史 - 生产环境建议使用Redis或数据库
 conversation_history = []
 
-# 用于跟踪每个会话的成本基线
-session_baselines = {}
-current_session_id = "default"
+# 每个会话的累计成本（由各请求自己的 CostTracker 累加，不再用全局计数器前后相减，并发请求不会互相串账）
+# 只在事件循环线程里读写，不需要加锁
+session_costs = {}
 
 class ChatRequest(BaseModel):
     query: str
@@ -75,15 +76,16 @@ def extract_content_from_error(error_msg: str) -> str:
     # 实在提取不出来就返回整个错误信息
     return error_msg
 
-def get_session_baseline(session_id: str) -> dict:
-    """获取或创建会话的成本基线"""
-    if session_id not in session_baselines:
-        session_baselines[session_id] = {
-            'input': cost_tracker.total_input_tokens,
-            'output': cost_tracker.total_output_tokens,
-            'cost': cost_tracker.total_cost
-        }
-    return session_baselines[session_id]
+def new_session_cost() -> dict:
+    return {"input_tokens": 0, "output_tokens": 0, "cache_hit_tokens": 0, "cost": 0.0}
+
+def add_session_cost(session_id: str, tracker) -> None:
+    """把一次请求的成本累加到所属会话"""
+    total = session_costs.setdefault(session_id, new_session_cost())
+    total["input_tokens"] += tracker.total_input_tokens
+    total["output_tokens"] += tracker.total_output_tokens
+    total["cache_hit_tokens"] += tracker.total_cache_hit_tokens
+    total["cost"] += tracker.total_cost
 
 @app.post("/chat", response_model=ChatResponse)
 async def chat(request: ChatRequest):
@@ -91,25 +93,16 @@ async def chat(request: ChatRequest):
     主要的对话接口。处理用户输入，调用Agent，返回回复和成本信息。
     """
     try:
-        # 清空上次的思考日志
-        log_handler.reset()
-        
-        # 获取这个会话的基线成本
-        session_baseline = get_session_baseline(request.session_id)
-        
-        # 记录本次调用前的token数（用于计算增量）
-        before_tokens = {
-            'input': cost_tracker.total_input_tokens,
-            'output': cost_tracker.total_output_tokens,
-            'cost': cost_tracker.total_cost
-        }
+        # 这次请求自己的成本追踪和思考日志，不和同时进行的其他请求共用
+        tracker, log_handler, callbacks = new_request_callbacks()
         
         result = None
         thinking_log = None
         
         try:
-            # 调用Agent处理用户请求
-            agent_result = agent.invoke({"input": request.query})
+            # 调用Agent处理用户请求（放到线程池里跑，不阻塞事件循环，多个请求可以同时处理）
+            agent_result = await run_in_threadpool(agent.invoke, {"input": request.query},
+                                                   config={"callbacks": callbacks})
             result = agent_result.get("output", "")
             thinking_log = log_handler.get_full_log()
             
@@ -142,24 +135,17 @@ async def chat(request: ChatRequest):
             "session_id": request.session_id
         }
         
-        # 计算本次调用的成本（增量计算，避免累加）
+        # 本次调用的成本就是这次请求自己的 CostTracker 记下的数
         if TRACK_COSTS:
-            # 计算相对于会话开始的总成本
-            session_cost = {
-                "input_tokens": cost_tracker.total_input_tokens - session_baseline['input'],
-                "output_tokens": cost_tracker.total_output_tokens - session_baseline['output'],
-                "total_cost": f"¥{cost_tracker.total_cost - session_baseline['cost']:.4f}"
-            }
-            
-            # 计算本次调用的增量成本
-            this_call_cost = {
-                "input_tokens": cost_tracker.total_input_tokens - before_tokens['input'],
-                "output_tokens": cost_tracker.total_output_tokens - before_tokens['output'],
-                "total_cost": f"¥{cost_tracker.total_cost - before_tokens['cost']:.4f}"
-            }
+            add_session_cost(request.session_id, tracker)
             
             # 只返回本次调用的成本
-            response_data["cost"] = this_call_cost
+            response_data["cost"] = {
+                "input_tokens": tracker.total_input_tokens,
+                "output_tokens": tracker.total_output_tokens,
+                "cache_hit_tokens": tracker.total_cache_hit_tokens,
+                "total_cost": f"¥{tracker.total_cost:.4f}"
+            }
         
         # 保存到对话历史
         conversation_history.append({
@@ -233,18 +219,14 @@ async def clear_history(session_id: Optional[str] = None):
             msg for msg in conversation_history 
             if msg.get("session_id", "default") != session_id
         ]
-        # 重置该会话的成本基线
-        if session_id in session_baselines:
-            session_baselines[session_id] = {
-                'input': cost_tracker.total_input_tokens,
-                'output': cost_tracker.total_output_tokens,
-                'cost': cost_tracker.total_cost
-            }
+        # 重置该会话的累计成本
+        if session_id in session_costs:
+            session_costs[session_id] = new_session_cost()
         return {"message": f"会话 {session_id} 的历史已清除"}
     else:
         # 清除所有历史
         conversation_history = []
-        session_baselines.clear()
+        session_costs.clear()
         return {"message": "所有对话历史已清除"}
 
 @app.get("/download-logs")
@@ -294,7 +276,7 @@ async def download_logs(format: str = "json"):
                 "export_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
                 "total_conversations": len(conversation_history),
                 "conversations": conversation_history,
-                "sessions": list(session_baselines.keys())
+                "sessions": list(session_costs.keys())
             }
             
             # 添加总成本统计
@@ -333,13 +315,9 @@ async def download_logs(format: str = "json"):
 @app.post("/reset-session")
 async def reset_session(session_id: str = "default"):
     """
-    重置特定会话的成本基线，用于开始新的计费周期
+    重置特定会话的累计成本，用于开始新的计费周期
     """
-    session_baselines[session_id] = {
-        'input': cost_tracker.total_input_tokens,
-        'output': cost_tracker.total_output_tokens,
-        'cost': cost_tracker.total_cost
-    }
+    session_costs[session_id] = new_session_cost()
     return {"message": f"会话 {session_id} 的成本计数已重置"}
 
 @app.get("/health")
@@ -352,7 +330,7 @@ async def health():
         "tools_enabled": True,
         "tracking_costs": TRACK_COSTS,
         "conversations_count": len(conversation_history),
-        "active_sessions": len(session_baselines),
+        "active_sessions": len(session_costs),
         "uptime": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
 
@@ -383,7 +361,15 @@ async def get_stats():
         "unique_sessions": unique_sessions,
         "average_response_length": avg_response_length,
         "total_cost": f"¥{total_cost_value:.4f}",
-        "cost_tracking_enabled": TRACK_COSTS
+        "cost_tracking_enabled": TRACK_COSTS,
+        # 服务启动以来所有请求的 LLM 用量（各请求的 CostTracker 加锁累加到全局 cost_tracker）
+        "llm_usage": {
+            "input_tokens": cost_tracker.total_input_tokens,
+            "output_tokens": cost_tracker.total_output_tokens,
+            "cache_hit_tokens": cost_tracker.total_cache_hit_tokens,
+            "total_cost": f"¥{cost_tracker.total_cost:.4f}"
+        } if TRACK_COSTS else None,
+        "search_cache": search_cache.stats()  # 命中率、内存/磁盘条目数，用来调缓存大小
     }
 
 if __name__ == "__main__":